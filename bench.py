@@ -0,0 +1,348 @@
+"""
+Load test for the dispatcher: feeds synthetic updates from simulated users straight into dp,
+with a fake Bot API server and the memory database (with an optional delay per call) behind it.
+
+    python bench.py --users 500 --updates 20000 --rate 1000 --db-latency 0.002
+
+Every user goes /start, then cycles through the about button, the new question button and a question;
+a staff member lists and answers questions every --staff-every updates. A user's updates are handled
+in order, different users run concurrently. --rate 0 sends everything at once.
+
+    python bench.py --broadcast 100000
+
+runs a /рассылка instead: that many memory profiles (every 50th banned, every 50th blocked)
+get one broadcast through the send queue and the fake Bot API, with the configured batch size.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import pickle
+import socket
+import time
+import tracemalloc
+
+from aiohttp import web
+
+import configurebot
+
+STAFF_ID = 1
+STAFF_CHAT = -100
+FIRST_USER = 1000
+
+
+class FakeBotAPI:
+    # answers Bot API calls the way Telegram would, after an optional delay
+    def __init__(self, latency):
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+
+    async def handle(self, request):
+        method = request.match_info['method'].lower()
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({'ok': True, 'result': self.result(method, data)})
+
+    def result(self, method, data):
+        if method == 'getme':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method == 'sendmediagroup':
+            return [self.message(data) for _ in json.loads(data['media'])]
+        if method.startswith('send'):
+            return self.message(data)
+        return True
+
+    def message(self, data):
+        chat_id = int(data['chat_id'])
+        return {'message_id': next(self.message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'}}
+
+
+def serve_fake_api(port, latency):
+    # runs in its own process, so the server's work doesn't count against the bot
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', FakeBotAPI(latency).handle)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, handle_signals=False)
+
+
+def start_fake_api(port, latency):
+    process = multiprocessing.Process(target=serve_fake_api, args=(port, latency), daemon=True)
+    process.start()
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            if time.monotonic() > deadline:
+                process.terminate()
+                raise
+            time.sleep(0.05)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+_update_ids = itertools.count(1)
+
+
+def make_update(uid, text, chat_id=None):
+    message = {'message_id': next(_update_ids), 'date': int(time.time()), 'text': text,
+               'chat': {'id': chat_id or uid, 'type': 'private' if chat_id is None else 'supergroup'},
+               'from': {'id': uid, 'is_bot': False, 'first_name': 'User', 'username': f'user{uid}'}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def workload(users, total, staff_every):
+    # (uid, update) pairs, round-robin over users
+    cfg = configurebot.cfg
+    cycle = [cfg['button_about_us'], cfg['button_new_question'], None]
+    sent = dict.fromkeys(range(FIRST_USER, FIRST_USER + users), 0)
+    tickets = itertools.count(1)
+    for i in range(total):
+        if staff_every and i % staff_every == staff_every - 1:
+            text = '/вопросы' if i // staff_every % 2 else f'/ответ #{next(tickets)} Ответ'
+            yield STAFF_ID, make_update(STAFF_ID, text, STAFF_CHAT)
+            continue
+        uid = FIRST_USER + i % users
+        step = sent[uid]
+        sent[uid] += 1
+        text = '/start' if step == 0 else cycle[(step - 1) % 3] or f'Вопрос {i} от {uid}'
+        yield uid, make_update(uid, text)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+async def process(dp, update, previous, latencies):
+    if previous is not None:
+        await previous
+    start = time.perf_counter()
+    await dp.process_updates([update])
+    latencies.append(time.perf_counter() - start)
+
+
+async def feed(dp, updates, rate):
+    from aiogram import types
+    loop = asyncio.get_running_loop()
+    latencies = []
+    last = {}
+    tasks = []
+    start = loop.time()
+    for i, (uid, update) in enumerate(updates):
+        if rate:
+            delay = start + i / rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        task = asyncio.create_task(process(dp, types.Update(**update), last.get(uid), latencies))
+        last[uid] = task
+        tasks.append(task)
+    await asyncio.gather(*tasks)
+    return latencies, loop.time() - start
+
+
+def fsm_usage(database, storage):
+    docs = database.collections.get('fsm')
+    docs = list(docs.docs.values()) if docs is not None else []
+    return {'documents': len(docs), 'bytes': len(pickle.dumps(docs)), 'locks': len(storage._locks)}
+
+
+async def run(args):
+    from aiogram import Bot, Dispatcher
+    import main
+    import metrics
+    from database import get_database
+    from handlers import db
+
+    logging.getLogger().setLevel(logging.WARNING)
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    await main.on_startup(main.dp)
+    await db.db_profile_register(STAFF_ID, 'staff')
+    await db.db_profile_set(STAFF_ID, access=3)
+
+    database = get_database()
+    db_calls = sum(metrics.db_calls.values.values())
+    handler_db_calls = dict(metrics.handler_db_calls.values)
+    api_calls = metrics.snapshot()['api_calls']
+    fsm_before = fsm_usage(database, main.dp.storage)
+    if args.tracemalloc:
+        tracemalloc.start()
+    updates = list(workload(args.users, args.updates, args.staff_every))
+    # client_start prints every new user
+    with contextlib.redirect_stdout(io.StringIO()):
+        latencies, elapsed = await feed(main.dp, updates, args.rate)
+    traced = tracemalloc.get_traced_memory()[0] if args.tracemalloc else None
+    fsm_after = fsm_usage(database, main.dp.storage)
+    db_calls = sum(metrics.db_calls.values.values()) - db_calls
+    handler_db_calls = {labels[0]: n - handler_db_calls.get(labels, 0)
+                        for labels, n in metrics.handler_db_calls.values.items()}
+
+    await main.on_shutdown(main.dp)
+    await (await main.bot.get_session()).close()
+    api_calls = metrics.snapshot()['api_calls'] - api_calls
+
+    latencies.sort()
+    return {
+        'updates': len(latencies),
+        'users': args.users,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(len(latencies) / elapsed, 1),
+        'update_p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'update_p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'handlers': {name: {'count': stats['count'], 'p50_ms': stats['p50'] * 1000, 'p99_ms': stats['p99'] * 1000,
+                            'db_calls': round(handler_db_calls.get(name, 0) / stats['count'], 2)}
+                     for name, stats in metrics.snapshot()['handlers'].items()},
+        # state lookups in the filters and whatever runs before a handler is picked
+        'dispatch_db_calls_per_update': round(handler_db_calls.get('unknown', 0) / len(latencies), 2),
+        'handler_errors': sum(metrics.handler_errors.values.values()),
+        'throttled': sum(metrics.throttled.values.values()),
+        'db_calls_per_update': round(db_calls / len(latencies), 2),
+        'api_calls_per_update': round(api_calls / len(latencies), 2),
+        'fsm_documents': fsm_after['documents'] - fsm_before['documents'],
+        'fsm_bytes': fsm_after['bytes'] - fsm_before['bytes'],
+        'fsm_locks': fsm_after['locks'],
+        'traced_memory_bytes': traced,
+    }
+
+
+def seed_profiles(database, count):
+    # written in place: insert_one checks the unique username index against every profile
+    profiles = database.collections['profiles']
+    for uid in range(FIRST_USER, FIRST_USER + count):
+        profiles.docs[uid] = {'_id': uid, 'access': 0, 'ban': int(uid % 50 == 0), 'blocked': int(uid % 50 == 1)}
+    return sum(1 for doc in profiles.docs.values() if not doc['ban'] and not doc.get('blocked'))
+
+
+async def run_broadcast(args):
+    from aiogram import Bot, Dispatcher
+    import main
+    import metrics
+    from database import get_database
+    from handlers import broadcast, db
+
+    logging.getLogger().setLevel(logging.WARNING)
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    await main.on_startup(main.dp)
+    database = get_database()
+    eligible = seed_profiles(database, args.broadcast)
+
+    db_calls = sum(metrics.db_calls.values.values())
+    api_calls = metrics.snapshot()['api_calls']
+    if args.tracemalloc:
+        tracemalloc.start()
+    start = time.perf_counter()
+    broadcast.broadcaster.start(await db.db_broadcast_create('Bench', STAFF_ID))
+    await asyncio.gather(*broadcast.broadcaster.tasks.values())
+    elapsed = time.perf_counter() - start
+    traced = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    result = await db.db_broadcast_last()
+    db_calls = sum(metrics.db_calls.values.values()) - db_calls
+
+    await main.on_shutdown(main.dp)
+    await (await main.bot.get_session()).close()
+    api_calls = metrics.snapshot()['api_calls'] - api_calls
+    return {
+        'profiles': args.broadcast,
+        'eligible': eligible,
+        'status': result['status'],
+        'sent': result['sent'],
+        'failed': result['failed'],
+        'blocked': result['blocked'],
+        'seconds': round(elapsed, 3),
+        'deliveries_per_second': round(result['sent'] / elapsed, 1),
+        'db_calls_per_1000_deliveries': round(db_calls * 1000 / max(1, result['sent']), 2),
+        # the status message to the author is one more call
+        'api_calls': api_calls,
+        'traced_memory_peak_bytes': traced,
+    }
+
+
+def report_broadcast(result):
+    print(f"broadcast to {result['profiles']} profiles ({result['eligible']} eligible): {result['status']}, "
+          f"sent {result['sent']}, failed {result['failed']}, blocked {result['blocked']}")
+    print(f"{result['seconds']}s, {result['deliveries_per_second']} deliveries/s, "
+          f"{result['db_calls_per_1000_deliveries']} db calls per 1000 deliveries, {result['api_calls']} api calls")
+    if result['traced_memory_peak_bytes'] is not None:
+        print(f"traced memory peak: {result['traced_memory_peak_bytes']} bytes")
+
+
+def report(result):
+    print(f"{result['updates']} updates from {result['users']} users in {result['seconds']}s: "
+          f"{result['updates_per_second']} updates/s")
+    print(f"update latency p50 {result['update_p50_ms']} ms, p99 {result['update_p99_ms']} ms")
+    print('handler latency (histogram bucket bounds) and db calls per call:')
+    for name, stats in sorted(result['handlers'].items()):
+        print(f"  {name:<20} {stats['count']:>7}  p50 <= {stats['p50_ms']:g} ms  p99 <= {stats['p99_ms']:g} ms"
+              f"  db {stats['db_calls']:g}")
+    print(f"db calls before a handler is picked (state lookups): {result['dispatch_db_calls_per_update']} per update")
+    print(f"handler errors: {result['handler_errors']}, throttled: {result['throttled']}")
+    print(f"db calls per update: {result['db_calls_per_update']}, api calls per update: {result['api_calls_per_update']}")
+    print(f"fsm storage growth: {result['fsm_documents']} documents, {result['fsm_bytes']} bytes, "
+          f"{result['fsm_locks']} locks held")
+    if result['traced_memory_bytes'] is not None:
+        print(f"traced memory growth: {result['traced_memory_bytes']} bytes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive the dispatcher with synthetic updates.')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=500, help='updates per second, 0 sends all at once')
+    parser.add_argument('--staff-every', type=int, default=50, help='one staff command per this many updates, 0 for none')
+    parser.add_argument('--db-latency', type=float, default=0, help='seconds added to every database call')
+    parser.add_argument('--api-latency', type=float, default=0, help='seconds added to every Bot API call')
+    parser.add_argument('--api-port', type=int, default=0, help='port of the fake Bot API server, 0 picks a free one')
+    parser.add_argument('--throttle', action='store_true', help='keep the configured flood limits (off by default)')
+    parser.add_argument('--broadcast', type=int, default=0, help='run a broadcast to this many profiles instead')
+    parser.add_argument('--tracemalloc', action='store_true', help='also report Python memory growth (slower)')
+    parser.add_argument('--json', action='store_true', help='print the result as one JSON line')
+    args = parser.parse_args()
+    args.api_port = args.api_port or free_port()
+
+    # must be set before bot.py and database.py are imported
+    configurebot.cfg.update({
+        'token': '123456:bench',
+        'api_server': f'http://127.0.0.1:{args.api_port}',
+        'teh_chat_id': STAFF_CHAT,
+        'dev_id': STAFF_ID,
+        'db_backend': 'memory',
+        'db_memory_latency': args.db_latency,
+        'metrics_port': 0,
+        'metrics_log_interval': 0,
+        # the fake server has no flood limits
+        'send_global_rate': 1000000,
+        'send_chat_rate': 1000000,
+        'send_group_rate': 1000000,
+        'broadcast_rate': 1000000,
+    })
+    if not args.throttle:
+        # simulated users click much faster than the flood limits allow
+        configurebot.cfg['throttle_limits'] = {'default': (float('inf'), 60)}
+    api = start_fake_api(args.api_port, args.api_latency)
+    try:
+        result = asyncio.run(run_broadcast(args) if args.broadcast else run(args))
+    finally:
+        api.terminate()
+    if args.json:
+        print(json.dumps(result))
+    elif args.broadcast:
+        report_broadcast(result)
+    else:
+        report(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,12 @@
-from aiogram import Bot
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.dispatcher import Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from storage import MongoStorage
+from metrics import InstrumentedBot, MetricsMiddleware
 import configurebot
 
-storage=MemoryStorage()
-bot = Bot(token=configurebot.cfg['token'])
-dp = Dispatcher(bot, storage=storage)
\ No newline at end of file
+storage=MongoStorage(ttl=configurebot.cfg['fsm_ttl'])
+api_server = configurebot.cfg['api_server']
+bot = InstrumentedBot(token=configurebot.cfg['token'],
+                      server=TelegramAPIServer.from_base(api_server) if api_server else TELEGRAM_PRODUCTION)
+dp = Dispatcher(bot, storage=storage)
+dp.middleware.setup(MetricsMiddleware())
\ No newline at end of file
@@ -9,6 +9,68 @@ cfg = {
 	'db_name': 'db_muiv',
 
 
+#database
+	'db_backend': 'mongo', # 'mongo' or 'memory' (local stand-in, data is lost on restart)
+	'db_memory_latency': 0, # seconds added to every call of the memory backend, for benchmarks
+	'db_pool_size': 50,
+	'db_timeout_ms': 5000,
+	'db_cache_size': 10000, # profiles kept in the in-process cache
+	'db_cache_ttl': 60, # seconds; the cache is per worker, so with several workers a /бан or /доступ
+	                    # handled by one of them reaches the others only after this long: keep it at a few seconds there
+	'tickets_page_size': 10, # open questions per /вопросы page
+	'fsm_ttl': 86400, # seconds before an unfinished question state is dropped
+
+
+#runtime
+	'mode': 'polling', # 'polling' or 'webhook'
+	'skip_updates': False, # drop updates that arrived while the bot was down
+	'shutdown_timeout': 30, # seconds to let in-flight updates finish
+	'api_server': '', # base URL of a self-hosted Bot API server, empty for api.telegram.org
+	'webhook_url': 'https://example.com',
+	'webhook_path': '/webhook',
+	'webhook_max_connections': 40, # updates Telegram delivers in parallel
+	'webapp_host': '0.0.0.0',
+	'webapp_port': 8080,
+
+
+#questions
+	'media_group_window': 1, # seconds without new parts before an album is forwarded
+
+#outbound messages (rates are messages per second)
+	'send_concurrency': 8,
+	'send_global_rate': 30,
+	'send_chat_rate': 1,
+	'send_group_rate': 0.33, # Telegram allows about 20 messages a minute in a group
+	'send_retries': 5,
+	'broadcast_rate': 20, # broadcast messages per second, leaves the rest of send_global_rate to regular traffic
+	'broadcast_batch': 100, # deliveries between checkpoints
+
+
+#flood control (limits are (messages, seconds) per user)
+	'throttle_backend': 'memory', # 'memory', or 'shared' to count in the database when several workers run
+	'throttle_max_keys': 50000, # user/command counters kept in memory, the least recently active go first
+	'throttle_limits': {
+		'default': (20, 60),
+		'message': (10, 60), # question text and anything that isn't a command or a button
+		'start': (5, 60),
+		'button_new_question': (3, 60),
+		'button_about_us': (5, 60),
+		'ответ': (60, 60),
+	},
+
+
+#developer error reports
+	'error_digest_interval': 60, # seconds between digests
+	'error_digest_max_interval': 3600, # longest gap between digests during an error storm
+	'error_storm_threshold': 50, # errors per digest that make the next one come later
+
+
+#metrics (served at /metrics on metrics_host:metrics_port in both modes, never on the public webhook server)
+	'metrics_host': '127.0.0.1',
+	'metrics_port': 9100, # 0 turns the endpoint off
+	'metrics_log_interval': 60, # seconds between summary log lines, 0 turns them off
+
+
 #buttons on board
 	'button_new_question': '✉ Задать вопрос',
 	'button_about_us': '📚 Про нас',
@@ -21,6 +83,7 @@ cfg = {
 	'ban_message': '⚠ Вы *забанены* в боте!',
 	'question_type_ur_question_message': '📝 Введите ваш вопрос (Можно прикрепить фото):',
 	'question_ur_question_sended_message': '✉ Ваш запрос оработан! Ожидайте ответа от тех.поддержки.',
+	'throttle_message': '⚠ Слишком *много* сообщений! Подождите немного и попробуйте снова.',
 
 
 #levels
@@ -0,0 +1,470 @@
+import asyncio
+import copy
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from configurebot import cfg
+from metrics import InstrumentedDatabase
+
+try:
+    from pymongo import ReturnDocument
+    from pymongo.errors import DuplicateKeyError
+except ImportError:
+    class ReturnDocument:
+        BEFORE = False
+        AFTER = True
+
+    class DuplicateKeyError(Exception):
+        pass
+
+ASCENDING = 1
+DESCENDING = -1
+
+
+#in-memory stand-in backend (db_backend = 'memory')
+
+def _get(doc, key):
+    for part in key.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+def _has(doc, key):
+    for part in key.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return False
+        doc = doc[part]
+    return True
+
+def _eq(value, expected):
+    if isinstance(value, list) and not isinstance(expected, list):
+        return expected in value
+    return value == expected
+
+def _match_value(doc, key, cond):
+    value = _get(doc, key)
+    if not isinstance(cond, dict) or not any(k.startswith('$') for k in cond):
+        return _eq(value, cond)
+    for op, arg in cond.items():
+        if op == '$ne':
+            if _eq(value, arg):
+                return False
+        elif op == '$in':
+            if not any(_eq(value, a) for a in arg):
+                return False
+        elif op == '$nin':
+            if any(_eq(value, a) for a in arg):
+                return False
+        elif op == '$regex':
+            if not isinstance(value, str) or not re.search(arg, value):
+                return False
+        elif op == '$exists':
+            if _has(doc, key) != bool(arg):
+                return False
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            if value is None:
+                return False
+            if op == '$gt' and not value > arg:
+                return False
+            if op == '$gte' and not value >= arg:
+                return False
+            if op == '$lt' and not value < arg:
+                return False
+            if op == '$lte' and not value <= arg:
+                return False
+        else:
+            raise ValueError(f'Unsupported query operator: {op}')
+    return True
+
+def _match(doc, query):
+    return all(_match_value(doc, key, cond) for key, cond in (query or {}).items())
+
+def _set(doc, key, value):
+    *path, last = key.split('.')
+    for part in path:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+def _unset(doc, key):
+    *path, last = key.split('.')
+    for part in path:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+def _apply_update(doc, update, inserting=False):
+    for op, fields in update.items():
+        for key, value in fields.items():
+            if op == '$set' or (op == '$setOnInsert' and inserting):
+                _set(doc, key, copy.deepcopy(value))
+            elif op == '$unset':
+                _unset(doc, key)
+            elif op == '$inc':
+                _set(doc, key, (_get(doc, key) or 0) + value)
+            elif op != '$setOnInsert':
+                raise ValueError(f'Unsupported update operator: {op}')
+
+def _project(doc, projection):
+    if doc is None or not projection:
+        return copy.deepcopy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = dict.fromkeys(projection, 1)
+    if any(projection.values()):
+        out = {k: copy.deepcopy(doc[k]) for k, v in projection.items() if v and k != '_id' and k in doc}
+        if projection.get('_id', 1) and '_id' in doc:
+            out['_id'] = doc['_id']
+        return out
+    return {k: copy.deepcopy(v) for k, v in doc.items() if projection.get(k, 1)}
+
+def _query_seed(query):
+    return {k: v for k, v in (query or {}).items()
+            if not k.startswith('$') and not (isinstance(v, dict) and any(o.startswith('$') for o in v))}
+
+
+class InsertOneResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class UpdateResult:
+    def __init__(self, matched_count, modified_count, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+
+class MemoryCursor:
+    def __init__(self, docs, projection):
+        self._docs = docs
+        self._projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction=ASCENDING):
+        if isinstance(key, list):
+            self._sort.extend(key)
+        else:
+            self._sort.append((key, direction))
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def _result(self):
+        docs = self._docs
+        for key, direction in reversed(self._sort):
+            docs = sorted(docs, key=lambda d: (_get(d, key) is not None, _get(d, key)), reverse=direction == DESCENDING)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return [_project(d, self._projection) for d in docs]
+
+    async def to_list(self, length=None):
+        docs = self._result()
+        return docs if length is None else docs[:length]
+
+    async def __aiter__(self):
+        for doc in self._result():
+            yield doc
+
+
+class MemoryCollection:
+    def __init__(self, name, latency=0):
+        self.name = name
+        self.docs = {}
+        self.indexes = {'_id_': {'key': [('_id', ASCENDING)]}}
+        self.latency = latency
+        self.calls = 0
+
+    async def _call(self):
+        # a simulated round trip, so benchmarks can put a realistic database behind the handlers
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _find(self, query):
+        if query and '_id' in query and not isinstance(query['_id'], dict):
+            doc = self.docs.get(query['_id'])
+            return [doc] if doc is not None and _match(doc, query) else []
+        return [d for d in self.docs.values() if _match(d, query)]
+
+    def _assign_id(self, doc):
+        # only scans for the next free id when the document doesn't bring its own
+        if '_id' not in doc:
+            doc['_id'] = max((k for k in self.docs if isinstance(k, int)), default=0) + 1
+
+    def _check_unique(self, doc):
+        for name, index in self.indexes.items():
+            if not index.get('unique') or len(index['key']) != 1:
+                continue
+            key = index['key'][0][0]
+            if index.get('sparse') and not _has(doc, key):
+                continue
+            value = _get(doc, key)
+            for other in self.docs.values():
+                if other['_id'] != doc['_id'] and _get(other, key) == value \
+                        and (_has(other, key) or not index.get('sparse')):
+                    raise DuplicateKeyError(f"E11000 duplicate key error: index {name} dup key {value!r}")
+
+    def _store(self, doc):
+        self._check_unique(doc)
+        self.docs[doc['_id']] = doc
+
+    async def create_index(self, keys, **options):
+        await self._call()
+        if isinstance(keys, str):
+            keys = [(keys, ASCENDING)]
+        name = options.pop('name', '_'.join(f'{k}_{d}' for k, d in keys))
+        if options.get('unique') and len(keys) == 1:
+            # like MongoDB, a unique index can't be built over documents that already break it
+            key, seen = keys[0][0], set()
+            for doc in self.docs.values():
+                if options.get('sparse') and not _has(doc, key):
+                    continue
+                value = _get(doc, key)
+                if value in seen:
+                    raise DuplicateKeyError(f"E11000 duplicate key error: index {name} dup key {value!r}")
+                seen.add(value)
+        self.indexes[name] = {'key': list(keys), **options}
+        return name
+
+    async def index_information(self):
+        await self._call()
+        return copy.deepcopy(self.indexes)
+
+    async def find_one(self, query=None, projection=None):
+        await self._call()
+        found = self._find(query)
+        return _project(found[0], projection) if found else None
+
+    def find(self, query=None, projection=None):
+        self.calls += 1
+        return MemoryCursor(self._find(query), projection)
+
+    async def count_documents(self, query):
+        await self._call()
+        return len(self._find(query))
+
+    async def insert_one(self, doc):
+        await self._call()
+        doc = copy.deepcopy(doc)
+        self._assign_id(doc)
+        if doc['_id'] in self.docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error: _id {doc['_id']!r}")
+        self._store(doc)
+        return InsertOneResult(doc['_id'])
+
+    async def update_one(self, query, update, upsert=False):
+        await self._call()
+        found = self._find(query)
+        if found:
+            doc = copy.deepcopy(found[0])
+            _apply_update(doc, update)
+            self._store(doc)
+            return UpdateResult(1, 1)
+        if not upsert:
+            return UpdateResult(0, 0)
+        doc = _query_seed(query)
+        _apply_update(doc, update, inserting=True)
+        self._assign_id(doc)
+        self._store(doc)
+        return UpdateResult(0, 0, doc['_id'])
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False,
+                                  return_document=ReturnDocument.BEFORE):
+        await self._call()
+        found = self._find(query)
+        if found:
+            before = found[0]
+            doc = copy.deepcopy(before)
+            _apply_update(doc, update)
+        elif upsert:
+            before = None
+            doc = _query_seed(query)
+            _apply_update(doc, update, inserting=True)
+            self._assign_id(doc)
+        else:
+            return None
+        self._store(doc)
+        return _project(doc if return_document else before, projection)
+
+    async def update_many(self, query, update):
+        await self._call()
+        found = self._find(query)
+        for doc in found:
+            doc = copy.deepcopy(doc)
+            _apply_update(doc, update)
+            self._store(doc)
+        return UpdateResult(len(found), len(found))
+
+    async def delete_one(self, query):
+        await self._call()
+        found = self._find(query)
+        if found:
+            del self.docs[found[0]['_id']]
+
+    async def delete_many(self, query):
+        await self._call()
+        for doc in self._find(query):
+            del self.docs[doc['_id']]
+
+
+class MemoryDatabase:
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name, self.latency)
+        return self.collections[name]
+
+    @property
+    def calls(self):
+        return sum(c.calls for c in self.collections.values())
+
+    def close(self):
+        pass
+
+
+#pymongo backend, every blocking call runs on a bounded thread pool
+
+class AsyncCursor:
+    def __init__(self, collection, cursor):
+        self._collection = collection
+        self._cursor = cursor
+        self._batch = 100
+
+    def sort(self, key, direction=ASCENDING):
+        self._cursor.sort(key, direction)
+        return self
+
+    def skip(self, count):
+        self._cursor.skip(count)
+        return self
+
+    def limit(self, count):
+        self._cursor.limit(count)
+        return self
+
+    def batch_size(self, size):
+        self._batch = size
+        self._cursor.batch_size(size)
+        return self
+
+    def _next_batch(self):
+        batch = []
+        for doc in self._cursor:
+            batch.append(doc)
+            if len(batch) >= self._batch:
+                break
+        return batch
+
+    async def to_list(self, length=None):
+        if length is not None:
+            self._cursor.limit(length)
+        return await self._collection._run(list, self._cursor)
+
+    async def __aiter__(self):
+        try:
+            while True:
+                batch = await self._collection._run(self._next_batch)
+                if not batch:
+                    return
+                for doc in batch:
+                    yield doc
+        finally:
+            self._cursor.close()
+
+
+class AsyncCollection:
+    def __init__(self, database, collection):
+        self._database = database
+        self._collection = collection
+        self.name = collection.name
+
+    def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._database.executor, partial(func, *args, **kwargs))
+
+    def find_one(self, *args, **kwargs):
+        return self._run(self._collection.find_one, *args, **kwargs)
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self, self._collection.find(*args, **kwargs))
+
+    def count_documents(self, *args, **kwargs):
+        return self._run(self._collection.count_documents, *args, **kwargs)
+
+    def create_index(self, *args, **kwargs):
+        return self._run(self._collection.create_index, *args, **kwargs)
+
+    def index_information(self):
+        return self._run(self._collection.index_information)
+
+    def insert_one(self, *args, **kwargs):
+        return self._run(self._collection.insert_one, *args, **kwargs)
+
+    def update_one(self, *args, **kwargs):
+        return self._run(self._collection.update_one, *args, **kwargs)
+
+    def update_many(self, *args, **kwargs):
+        return self._run(self._collection.update_many, *args, **kwargs)
+
+    def find_one_and_update(self, *args, **kwargs):
+        return self._run(self._collection.find_one_and_update, *args, **kwargs)
+
+    def delete_one(self, *args, **kwargs):
+        return self._run(self._collection.delete_one, *args, **kwargs)
+
+    def delete_many(self, *args, **kwargs):
+        return self._run(self._collection.delete_many, *args, **kwargs)
+
+
+class AsyncDatabase:
+    def __init__(self, url, name, pool_size, timeout_ms):
+        import pymongo
+        from pymongo.server_api import ServerApi
+
+        self.client = pymongo.MongoClient(url, server_api=ServerApi('1'),
+                                          maxPoolSize=pool_size,
+                                          serverSelectionTimeoutMS=timeout_ms,
+                                          connectTimeoutMS=timeout_ms,
+                                          socketTimeoutMS=timeout_ms,
+                                          waitQueueTimeoutMS=timeout_ms)
+        self.db = self.client[name]
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='db')
+
+    def __getitem__(self, name):
+        return AsyncCollection(self, self.db[name])
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.close()
+
+
+def connect():
+    if cfg['db_backend'] == 'memory':
+        return MemoryDatabase(cfg['db_memory_latency'])
+    return AsyncDatabase(cfg['db_url'], cfg['db_name'], cfg['db_pool_size'], cfg['db_timeout_ms'])
+
+_database = None
+
+def get_database():
+    # one shared connection pool for the data layer and the FSM storage
+    global _database
+    if _database is None:
+        _database = InstrumentedDatabase(connect())
+    return _database
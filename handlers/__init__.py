@@ -2,3 +2,5 @@ from handlers import client
 from handlers import admin
 from handlers import fsm
 from handlers import db
+from handlers import errors
+from handlers import broadcast
\ No newline at end of file
@@ -1,169 +1,132 @@
 from aiogram import types
 
-import kb
-from bot import dp, bot
 from handlers.fsm import *
-from handlers.db import db_profile_access, db_profile_exist, db_profile_updateone, db_profile_exist_usr, db_profile_get_usrname
+from handlers.db import db_profile_get_by_username, db_profile_set, \
+    db_ticket_get, db_ticket_get_by_staff_message, db_ticket_answer, db_tickets_open
 from configurebot import cfg
+from sender import sender
+import router
+from router import Arg, Rest, ticket_id
 
-errormessage = cfg['error_message']
 lvl1name = cfg['1lvl_adm_name']
 lvl2name = cfg['2lvl_adm_name']
 lvl3name = cfg['3lvl_adm_name']
-devid = cfg['dev_id']
+tehchatid = cfg['teh_chat_id']
+ticketspage = cfg['tickets_page_size']
+otusage = '`/ответ #12 Ваш ответ` или ответьте этой командой на сообщение с вопросом'
 
-def extract_arg(arg):
-    return arg.split()[1:]
-
-async def admin_ot(message: types.Message):
+async def deliver(message: types.Message, chat_id, text):
+    # waits for the send queue, so staff hear about it when the user didn't get the message
     try:
-        uid = message.from_user.id
+        await sender.send_message(chat_id, text, parse_mode='Markdown')
+    except Exception as e:
+        error = str(e).replace('`', "'")
+        await message.reply(f'⚠ Сообщение пользователю *не* доставлено: `{error}`', parse_mode='Markdown')
+        return False
+    return True
 
-        if(db_profile_access(uid) >= 1):
-            args = extract_arg(message.text)
-            if len(args) >= 2:
-                chatid = str(args[0])
-                args.pop(0)
-                answer = ""
-                for ot in args:
-                    answer+=ot+" "
-                await message.reply('✅ Вы успешно ответили на вопрос!')
-                await bot.send_message(chatid, f"✉ Новое уведомление!\nОтвет от тех.поддержки:\n\n`{answer}`",parse_mode='Markdown')
+async def admin_ot(message: types.Message, args):
+    uid = message.from_user.id
+    answer = args.text
+    ticket = None
+    chatid = None
+    if message.reply_to_message is not None and message.chat.id == tehchatid:
+        ticket = await db_ticket_get_by_staff_message(message.reply_to_message.message_id)
+    if ticket is None:
+        target, *rest = answer.split(maxsplit=1)
+        answer = rest[0] if rest else ''
+        if target.startswith('#'):
+            try:
+                ticket = await db_ticket_get(ticket_id(target))
+            except ValueError:
+                await message.reply(f'⚠ Укажите аргументы команды\nПример: {otusage}',parse_mode='Markdown')
                 return
-            else:
-                await message.reply('⚠ Укажите аргументы команды\nПример: `/ответ 516712732 Ваш ответ`',parse_mode='Markdown')
+            if ticket is None:
+                await message.reply('⚠ Такого вопроса *не* существует!', parse_mode='Markdown')
                 return
-        else:
+        elif answer:
+            chatid = target
+    if ticket is not None:
+        chatid = ticket['chat']
+    if chatid is not None and answer:
+        if not await deliver(message, chatid, f"✉ Новое уведомление!\nОтвет от тех.поддержки:\n\n`{answer}`"):
             return
-    except Exception as e:
-        cid = message.chat.id
-        await message.answer(f"{errormessage}",
-                             parse_mode='Markdown')
-        await bot.send_message(devid, f"Случилась *ошибка* в чате *{cid}*\nСтатус ошибки: `{e}`",
-                               parse_mode='Markdown')
+        await message.reply('✅ Вы успешно ответили на вопрос!')
+        if ticket is not None:
+            await db_ticket_answer(ticket['_id'], uid)
+        return
+    else:
+        await message.reply(f'⚠ Укажите аргументы команды\nПример: {otusage}',parse_mode='Markdown')
+        return
 
-async def admin_giveaccess(message: types.Message):
-    try:
-        uidown = message.from_user.id
-
-        if (db_profile_access(uidown) >= 3):
-            args = extract_arg(message.text)
-            if len(args) == 2:
-                uid = int(args[0])
-                access = int(args[1])
-                outmsg = ""      
-                if db_profile_exist(uid):
-                    if access == 0:
-                        outmsg = "✅ Вы успешно сняли все доступы с этого человека!"
-                    elif access == 1:
-                        outmsg = f"✅ Вы успешно выдали доступ *{lvl1name}* данному человеку!"
-                    elif access == 2:
-                        outmsg = f"✅ Вы успешно выдали доступ *{lvl2name}* данному человеку!"
-                    elif access == 3:
-                        outmsg = f"✅ Вы успешно выдали доступ *{lvl3name}* данному человеку!"
-                    else:
-                        await message.reply('⚠ Максимальный уровень доступа: *3*', parse_mode='Markdown')
-                        return
-                    db_profile_updateone({'_id': uid}, {"$set": {"access": access}})
-                    await message.reply(outmsg, parse_mode='Markdown')
-                    return
-                else:
-                    await message.reply("⚠ Этого пользователя *не* существует!",parse_mode='Markdown')
-                    return
-            else:
-                await message.reply('⚠ Укажите аргументы команды\nПример: `/доступ 516712372 1`',
-                                    parse_mode='Markdown')
-                return
+async def admin_tickets(message: types.Message, args):
+    page = await db_tickets_open(args.after, ticketspage)
+    if not page:
+        await message.reply('✅ Открытых вопросов нет!')
+        return
+    lines = []
+    for ticket in page:
+        # inside code spans, so a '_' in a username or a '`' in a question can't break the Markdown
+        who = f"`@{ticket['username']}`" if ticket.get('username') else ticket['user']
+        text = (ticket['text'] or '📷').replace('`', "'")
+        if len(text) > 100:
+            text = text[:100] + '…'
+        lines.append(f"*#{ticket['_id']}* от {who} ({ticket['created']:%d.%m %H:%M}):\n`{text}`")
+    if len(page) == ticketspage:
+        lines.append(f"\nДальше: `/вопросы {page[-1]['_id']}`")
+    await message.reply("\n\n".join(lines), parse_mode='Markdown')
 
+async def admin_giveaccess(message: types.Message, args):
+    outmsg = ""
+    if 0 <= args.access <= 3:
+        if args.access == 0:
+            outmsg = "✅ Вы успешно сняли все доступы с этого человека!"
+        elif args.access == 1:
+            outmsg = f"✅ Вы успешно выдали доступ *{lvl1name}* данному человеку!"
+        elif args.access == 2:
+            outmsg = f"✅ Вы успешно выдали доступ *{lvl2name}* данному человеку!"
+        elif args.access == 3:
+            outmsg = f"✅ Вы успешно выдали доступ *{lvl3name}* данному человеку!"
+        if await db_profile_set(args.uid, access=args.access):
+            await message.reply(outmsg, parse_mode='Markdown')
         else:
-            return
-    except Exception as e:
-        cid = message.chat.id
-        await message.answer(f"{errormessage}",
-                             parse_mode='Markdown')
-        await bot.send_message(devid, f"Случилась *ошибка* в чате *{cid}*\nСтатус ошибки: `{e}`",
-                               parse_mode='Markdown')
-
-async def admin_ban(message: types.Message):
-    try:
-        uidown = message.from_user.id
+            await message.reply("⚠ Этого пользователя *не* существует!",parse_mode='Markdown')
+        return
+    else:
+        await message.reply('⚠ Максимальный уровень доступа: *3*', parse_mode='Markdown')
+        return
 
-        if db_profile_access(uidown) >= 2:
-            args = extract_arg(message.text)
-            if len(args) == 2:
-                uid = int(args[0])
-                reason = args[1]
-                if db_profile_exist(uid):
-                    db_profile_updateone({"_id": uid}, {"$set": {'ban': 1}})
-                    await message.reply(f'✅ Вы успешно забанили этого пользователя\nПричина: `{reason}`',parse_mode='Markdown')
-                    await bot.send_message(uid, f"⚠ Администратор *заблокировал* Вас в боте\nПричина: `{reason}`", parse_mode='Markdown')
-                    return
-                else:
-                    await message.reply("⚠ Этого пользователя *не* существует!", parse_mode='Markdown')
-                    return
-            else:
-                await message.reply('⚠ Укажите аргументы команды\nПример: `/бан 51623722 Причина`',
-                                    parse_mode='Markdown')
-                return
-    except Exception as e:
-        cid = message.chat.id
-        await message.answer(f"{errormessage}",
-                             parse_mode='Markdown')
-        await bot.send_message(devid, f"Случилась *ошибка* в чате *{cid}*\nСтатус ошибки: `{e}`",
-                               parse_mode='Markdown')
-
-async def admin_unban(message: types.Message):
-    try:
-        uidown = message.from_user.id
+async def admin_ban(message: types.Message, args):
+    if await db_profile_set(args.uid, ban=1):
+        await message.reply(f'✅ Вы успешно забанили этого пользователя\nПричина: `{args.reason}`',parse_mode='Markdown')
+        await deliver(message, args.uid, f"⚠ Администратор *заблокировал* Вас в боте\nПричина: `{args.reason}`")
+    else:
+        await message.reply("⚠ Этого пользователя *не* существует!", parse_mode='Markdown')
 
-        if db_profile_access(uidown) >= 2:
-            args = extract_arg(message.text)
-            if len(args) == 1:
-                uid = int(args[0])
-                if db_profile_exist(uid):
-                    db_profile_updateone({"_id": uid}, {"$set": {'ban': 0}})
-                    await message.reply(f'✅ Вы успешно разблокировали этого пользователя',parse_mode='Markdown')
-                    await bot.send_message(uid, f"⚠ Администратор *разблокировал* Вас в боте!", parse_mode='Markdown')
-                    return
-                else:
-                    await message.reply("⚠ Этого пользователя *не* существует!", parse_mode='Markdown')
-                    return
-            else:
-                await message.reply('⚠ Укажите аргументы команды\nПример: `/разбан 516272834`',
-                                    parse_mode='Markdown')
-                return
-    except Exception as e:
-        cid = message.chat.id
-        await message.answer(f"{errormessage}",
-                             parse_mode='Markdown')
-        await bot.send_message(devid, f"Случилась *ошибка* в чате *{cid}*\nСтатус ошибки: `{e}`",
-                               parse_mode='Markdown')
+async def admin_unban(message: types.Message, args):
+    if await db_profile_set(args.uid, ban=0):
+        await message.reply(f'✅ Вы успешно разблокировали этого пользователя',parse_mode='Markdown')
+        await deliver(message, args.uid, f"⚠ Администратор *разблокировал* Вас в боте!")
+    else:
+        await message.reply("⚠ Этого пользователя *не* существует!", parse_mode='Markdown')
 
-async def admin_id(message: types.Message):
-    try:
-        args = extract_arg(message.text)
-        if len(args) == 1:
-            username = args[0]
-            if db_profile_exist_usr(username):
-                uid = db_profile_get_usrname(username, '_id')
-                await message.reply(f"🆔 {uid}")
-            else:
-                await message.reply("⚠ Этого пользователя *не* существует!", parse_mode='Markdown')
-                return
-        else:
-            await message.reply('⚠ Укажите аргументы команды\nПример: `/айди nosemka`',
-                                parse_mode='Markdown')
-            return
-    except Exception as e:
-        cid = message.chat.id
-        await message.answer(f"{errormessage}",
-                             parse_mode='Markdown')
-        await bot.send_message(devid, f"Случилась *ошибка* в чате *{cid}*\nСтатус ошибки: `{e}`",
-                               parse_mode='Markdown')
+async def admin_id(message: types.Message, args):
+    profile = await db_profile_get_by_username(args.username)
+    if profile is not None:
+        await message.reply(f"🆔 {profile['_id']}")
+    else:
+        await message.reply("⚠ Этого пользователя *не* существует!", parse_mode='Markdown')
 
 def register_handler_admin():
-    dp.register_message_handler(admin_ot, commands=['ответ', 'ot'])
-    dp.register_message_handler(admin_giveaccess, commands=['доступ', 'access'])
-    dp.register_message_handler(admin_ban, commands=['бан', 'ban'])
-    dp.register_message_handler(admin_unban, commands=['разбан', 'unban'])
-    dp.register_message_handler(admin_id, commands=['айди', 'id'])
\ No newline at end of file
+    router.command(['ответ', 'ot'], admin_ot, access=1, usage=otusage,
+                   args=[Rest('text')])
+    router.command(['вопросы', 'tickets'], admin_tickets, access=1, usage='`/вопросы 120`',
+                   args=[Arg('after', ticket_id, optional=True, default=0)])
+    router.command(['доступ', 'access'], admin_giveaccess, access=3, usage='`/доступ 516712372 1`',
+                   args=[Arg('uid', int), Arg('access', int)])
+    router.command(['бан', 'ban'], admin_ban, access=2, usage='`/бан 51623722 Причина`',
+                   args=[Arg('uid', int), Rest('reason')])
+    router.command(['разбан', 'unban'], admin_unban, access=2, usage='`/разбан 516272834`',
+                   args=[Arg('uid', int)])
+    router.command(['айди', 'id'], admin_id, usage='`/айди nosemka`',
+                   args=[Arg('username')])
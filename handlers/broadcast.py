@@ -0,0 +1,129 @@
+import asyncio
+import logging
+
+from aiogram import types
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, UserDeactivated
+
+from configurebot import cfg
+from handlers.db import db_profiles_stream, db_profiles_mark_blocked, \
+    db_broadcast_create, db_broadcast_checkpoint, db_broadcast_finish, db_broadcasts_running, db_broadcast_last
+import metrics
+import router
+from router import Rest
+from sender import sender, TokenBucket, PRIORITY_BULK, PRIORITY_STAFF
+
+log = logging.getLogger(__name__)
+
+broadcastusage = '`/рассылка Оплата до 25 числа`'
+
+
+class Broadcaster:
+    """
+    Sends a broadcast to every profile that isn't banned or known to have blocked the bot.
+
+    Profiles are streamed in _id order and sent in batches; after each batch the last id and the
+    counters are saved, so a broadcast interrupted by a restart resumes from its last checkpoint.
+    A shutdown lets the current batch finish and checkpoint first, so nobody gets the text twice;
+    after a crash at most one batch is sent again. Deliveries go through the send queue at the lowest priority,
+    paced by their own token bucket so regular traffic keeps part of the global rate.
+    """
+
+    def __init__(self, rate, batch):
+        self.rate = rate
+        self.batch = batch
+        self.tasks = {}
+        self.stopping = False
+
+    def start(self, broadcast):
+        task = asyncio.create_task(self._run(broadcast))
+        self.tasks[broadcast['_id']] = task
+        task.add_done_callback(lambda _: self.tasks.pop(broadcast['_id'], None))
+
+    async def resume(self):
+        for broadcast in await db_broadcasts_running():
+            log.info('Resuming broadcast #%s after %s', broadcast['_id'], broadcast['last_uid'])
+            self.start(broadcast)
+
+    async def stop(self, timeout):
+        # status stays 'running', so the next start picks it up from the checkpoint
+        self.stopping = True
+        tasks = list(self.tasks.values())
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, broadcast):
+        bid = broadcast['_id']
+        bucket = TokenBucket(self.rate, self.rate)
+        try:
+            uids = []
+            async for uid in db_profiles_stream(broadcast['last_uid'], self.batch):
+                uids.append(uid)
+                if len(uids) == self.batch:
+                    await self._send_batch(bid, broadcast['text'], uids, bucket)
+                    uids = []
+                    if self.stopping:
+                        return
+            if uids:
+                await self._send_batch(bid, broadcast['text'], uids, bucket)
+        except Exception:
+            log.exception('Broadcast #%s failed', bid)
+            broadcast = await db_broadcast_finish(bid, 'failed')
+        else:
+            broadcast = await db_broadcast_finish(bid, 'done')
+        sender.send_message(broadcast['author'], render_status(broadcast), priority=PRIORITY_STAFF, parse_mode='Markdown')
+
+    async def _send_batch(self, bid, text, uids, bucket):
+        deliveries = []
+        for uid in uids:
+            while True:
+                wait = bucket.take()
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+            deliveries.append(sender.send_message(uid, text, priority=PRIORITY_BULK))
+        results = await asyncio.gather(*deliveries, return_exceptions=True)
+        sent = failed = 0
+        blocked = []
+        for uid, result in zip(uids, results):
+            if isinstance(result, (BotBlocked, ChatNotFound, UserDeactivated)):
+                blocked.append(uid)
+            elif isinstance(result, Exception):
+                failed += 1
+            else:
+                sent += 1
+        metrics.broadcast_messages.inc('sent', value=sent)
+        metrics.broadcast_messages.inc('failed', value=failed)
+        metrics.broadcast_messages.inc('blocked', value=len(blocked))
+        if blocked:
+            await db_profiles_mark_blocked(blocked)
+        await db_broadcast_checkpoint(bid, uids[-1], sent, failed, len(blocked))
+
+
+broadcaster = Broadcaster(rate=cfg['broadcast_rate'], batch=cfg['broadcast_batch'])
+
+
+def render_status(broadcast):
+    status = {'running': 'идёт', 'done': 'завершена', 'failed': 'прервана ошибкой'}[broadcast['status']]
+    return (f"📢 Рассылка *#{broadcast['_id']}* {status}\n"
+            f"Доставлено: *{broadcast['sent']}*\n"
+            f"Заблокировали бота: *{broadcast['blocked']}*\n"
+            f"Ошибок: *{broadcast['failed']}*")
+
+async def admin_broadcast(message: types.Message, args):
+    if not args.text:
+        broadcast = await db_broadcast_last()
+        if broadcast is None:
+            await message.reply(f'⚠ Укажите текст рассылки\nПример: {broadcastusage}', parse_mode='Markdown')
+            return
+        await message.reply(render_status(broadcast), parse_mode='Markdown')
+        return
+    broadcast = await db_broadcast_create(args.text, message.from_user.id)
+    broadcaster.start(broadcast)
+    await message.reply(f"✅ Рассылка *#{broadcast['_id']}* запущена! Итог придёт сюда же, статус: `/рассылка`", parse_mode='Markdown')
+
+def register_handler_broadcast():
+    router.command(['рассылка', 'broadcast'], admin_broadcast, access=3, usage=broadcastusage,
+                   args=[Rest('text', optional=True)])
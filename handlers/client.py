@@ -1,78 +1,59 @@
 from aiogram import types
 
 import kb
-from bot import dp, bot
+from bot import dp
 from handlers.fsm import *
-from handlers.db import db_profile_exist, db_profile_insertone, db_profile_banned
+from handlers.db import db_profile_get, db_profile_register
 from configurebot import cfg
-
+import metrics
+import router
 
 welcomemessage = cfg['welcome_message']
-errormessage = cfg['error_message']
-devid = cfg['dev_id']
 aboutus = cfg['about_us']
 question_first_msg = cfg['question_type_ur_question_message']
 
 handler_button_new_question = cfg['button_new_question']
 handler_button_about_us = cfg['button_about_us']
 
+def is_banned(profile):
+    return profile is not None and profile['ban'] == 1
 
 async def client_start(message: types.Message):
-    try:
-        if(message.chat.type != 'private'):
-            await message.answer('Данную команду можно использовать только в личных сообщениях с ботом.')
-            return
-        if db_profile_exist(message.from_user.id):
-            await message.answer(f'{welcomemessage}',parse_mode='Markdown', reply_markup=kb.mainmenu)
-        else:
-            db_profile_insertone({
-                '_id': message.from_user.id,
-                'username': message.from_user.username,
-                'access': 0,
-                'ban': 0
-            })
-            print('Новый пользователь!')
-            await message.answer(f'{welcomemessage}',parse_mode='Markdown', reply_markup=kb.mainmenu)
-    except Exception as e:
-        cid = message.chat.id
-        await message.answer(f"{errormessage}",
-                             parse_mode='Markdown')
-        await bot.send_message(devid, f"Случилась *ошибка* в чате *{cid}*\nСтатус ошибки: `{e}`",
-                               parse_mode='Markdown')
+    if(message.chat.type != 'private'):
+        await message.answer('Данную команду можно использовать только в личных сообщениях с ботом.')
+        return
+    if await db_profile_register(message.from_user.id, message.from_user.username):
+        print('Новый пользователь!')
+    await message.answer(f'{welcomemessage}',parse_mode='Markdown', reply_markup=kb.mainmenu)
 
 async def client_newquestion(message: types.Message):
-    try:
-        if message.text == handler_button_new_question:
-            if db_profile_banned(message.from_user.id):
-                await message.answer("⚠ Ви *заблоковані* у боті!", parse_mode='Markdown')
-                return
-            await message.answer(f"{question_first_msg}")
-            await FSMQuestion.text.set()
-        elif message.text == handler_button_about_us:
-            if db_profile_banned(message.from_user.id):
-                await message.answer("⚠ Ви *заблоковані* у боті!", parse_mode='Markdown')
-                return
-            await message.answer(f"{aboutus}", disable_web_page_preview=True, parse_mode='Markdown')
+    await message.answer(f"{question_first_msg}")
+    await FSMQuestion.text.set()
+
+async def client_aboutus(message: types.Message):
+    await message.answer(f"{aboutus}", disable_web_page_preview=True, parse_mode='Markdown')
+
+#reply keyboard button text -> handler
+buttons = {
+    handler_button_new_question: client_newquestion,
+    handler_button_about_us: client_aboutus,
+}
 
-    except Exception as e:
-        cid = message.chat.id
-        await message.answer(f"{errormessage}",
-                             parse_mode='Markdown')
-        await bot.send_message(devid, f"Случилась *ошибка* в чате *{cid}*\nСтатус ошибки: `{e}`",
-                               parse_mode='Markdown')
+def is_button(message: types.Message):
+    return message.text in buttons
 
+async def client_button(message: types.Message):
+    handler = buttons[message.text]
+    metrics.name_handler(handler.__name__)
+    if is_banned(await db_profile_get(message.from_user.id)):
+        await message.answer("⚠ Ви *заблоковані* у боті!", parse_mode='Markdown')
+        return
+    await handler(message)
 
 async def client_getgroupid(message: types.Message):
-    try:
-        await message.answer(f"Chat id is: *{message.chat.id}*\nYour id is: *{message.from_user.id}*", parse_mode='Markdown')
-    except Exception as e:
-        cid = message.chat.id
-        await message.answer(f"{errormessage}",
-                             parse_mode='Markdown')
-        await bot.send_message(devid, f"Случилась *ошибка* в чате *{cid}*\nСтатус ошибки: `{e}`",
-                               parse_mode='Markdown')
+    await message.answer(f"Chat id is: *{message.chat.id}*\nYour id is: *{message.from_user.id}*", parse_mode='Markdown')
 
 def register_handler_client():
-    dp.register_message_handler(client_start, commands='start', state=None)
-    dp.register_message_handler(client_getgroupid, commands='getchatid')
-    dp.register_message_handler(client_newquestion)
\ No newline at end of file
+    router.command(['start'], client_start)
+    router.command(['getchatid'], client_getgroupid)
+    dp.register_message_handler(client_button, is_button)
@@ -1,40 +1,264 @@
-import pymongo
-from pymongo.server_api import ServerApi
-from configurebot import cfg
+import asyncio
+import datetime
+import time
+from collections import OrderedDict
 
-dburl = cfg['db_url']
-db = cfg['db_name']
+from database import get_database, ASCENDING, DESCENDING, DuplicateKeyError, ReturnDocument
+from configurebot import cfg
 
-client = pymongo.MongoClient(dburl, server_api=ServerApi('1'))
-db = client[db]
+db = get_database()
 profiles = db['profiles']
+tickets = db['tickets']
+broadcasts = db['broadcasts']
+counters = db['counters']
 
-def db_profile_exist(uid):
-    if profiles.find_one({"_id": uid}) != None:
-        return True
-    else:
-        return False
+PROFILE_FIELDS = {'access': 1, 'ban': 1, 'username': 1}
+
+#collection -> [(keys, options)], ensured by db_ensure_indexes() at startup
+INDEXES = {
+    'profiles': [
+        ([('username', ASCENDING)], {'name': 'username_unique', 'unique': True, 'sparse': True}),
+    ],
+    'tickets': [
+        # open-ticket listing pages by _id within a status
+        ([('status', ASCENDING), ('_id', ASCENDING)], {'name': 'status_id'}),
+        ([('staff_message_ids', ASCENDING)], {'name': 'staff_message_ids', 'sparse': True}),
+    ],
+    'broadcasts': [
+        ([('status', ASCENDING)], {'name': 'status'}),
+    ],
+    'fsm': [
+        ([('updated', ASCENDING)], {'name': 'fsm_ttl', 'expireAfterSeconds': cfg['fsm_ttl']}),
+    ],
+    'fsm_locks': [
+        ([('expires', ASCENDING)], {'name': 'fsm_locks_ttl', 'expireAfterSeconds': 0}),
+    ],
+    'throttle': [
+        ([('expires', ASCENDING)], {'name': 'throttle_ttl', 'expireAfterSeconds': 0}),
+    ],
+}
+
+cache_size = cfg['db_cache_size']
+cache_ttl = cfg['db_cache_ttl']
+
+#uid -> (expires_at, profile or None); writes only invalidate this process's copy,
+#other workers keep theirs until it expires (see db_cache_ttl)
+_cache = OrderedDict()
+#uid -> future of the read currently in flight, so concurrent misses share one query
+_pending = {}
+
+async def db_profile_get(uid):
+    entry = _cache.get(uid)
+    if entry is not None:
+        if entry[0] > time.monotonic():
+            _cache.move_to_end(uid)
+            return entry[1]
+        del _cache[uid]
+    pending = _pending.get(uid)
+    if pending is not None:
+        try:
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise
+            # the caller that started the read was cancelled (client gone, shutdown), not this one
+            return await db_profile_get(uid)
+    future = asyncio.get_running_loop().create_future()
+    _pending[uid] = future
+    try:
+        doc = await profiles.find_one({'_id': uid}, PROFILE_FIELDS)
+    except BaseException as e:
+        if _pending.get(uid) is future:
+            del _pending[uid]
+        if isinstance(e, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(e)
+            future.exception()
+        raise
+    # an invalidation while the read was in flight drops it from _pending, the result may be stale then
+    if _pending.get(uid) is future:
+        del _pending[uid]
+        _cache[uid] = (time.monotonic() + cache_ttl, doc)
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    future.set_result(doc)
+    return doc
 
-def db_profile_exist_usr(username):
-    if profiles.find_one({"username": username}) != None:
-        return True
+async def db_profile_access(uid):
+    profile = await db_profile_get(uid)
+    return profile['access'] if profile is not None else 0
+
+def db_cache_invalidate(uid=None):
+    if uid is None:
+        _cache.clear()
+        _pending.clear()
     else:
-        return False
+        _cache.pop(uid, None)
+        _pending.pop(uid, None)
+
+def normalize_username(username):
+    if username is None:
+        return None
+    username = username.strip().lstrip('@').lower()
+    return username or None
 
-def db_profile_insertone(query):
-    return profiles.insert_one(query)
+async def _dedupe_usernames():
+    # before the unique index exists nothing stops two profiles holding the same name ('Ivan' and 'ivan',
+    # or an old nick nobody gave up), so each normalised name is kept by the first profile in _id order
+    seen = set()
+    async for doc in profiles.find({'username': {'$exists': True}}, {'username': 1}).sort('_id', ASCENDING):
+        username = normalize_username(doc['username'])
+        if username is None or username in seen:
+            await profiles.update_one({'_id': doc['_id']}, {'$unset': {'username': ''}})
+            continue
+        seen.add(username)
+        if username != doc['username']:
+            await profiles.update_one({'_id': doc['_id']}, {'$set': {'username': username}})
+    db_cache_invalidate()
 
-def db_profile_access(uid):
-    return profiles.find_one({'_id': uid})['access']
+async def db_ensure_indexes():
+    # usernames stored before normalisation would break the unique index or miss lookups
+    if 'username_unique' not in await profiles.index_information():
+        await _dedupe_usernames()
+    await profiles.update_many({'username': None}, {'$unset': {'username': ''}})
+    async for doc in profiles.find({'username': {'$regex': '[A-Z@]'}}, {'username': 1}):
+        await _set_username(doc['_id'], normalize_username(doc['username']))
+    # tickets forwarded before albums were supported had a single staff message
+    async for doc in tickets.find({'staff_message_id': {'$exists': True}}, {'staff_message_id': 1}):
+        await tickets.update_one({'_id': doc['_id']}, {'$set': {'staff_message_ids': [doc['staff_message_id']]},
+                                                       '$unset': {'staff_message_id': ''}})
+    for name, indexes in INDEXES.items():
+        for keys, options in indexes:
+            await db[name].create_index(keys, **options)
 
-def db_profile_banned(uid):
-    if profiles.find_one({'_id': uid})['ban'] == 1:
-        return True
+async def _set_username(uid, username, upsert=False, unblock=False):
+    # usernames are unique; a stale holder (someone who changed their nick) gives it up
+    update = {'$setOnInsert': {'access': 0, 'ban': 0}}
+    unset = {'blocked': ''} if unblock else {}
+    if username is None:
+        unset['username'] = ''
     else:
-        return False
+        update['$set'] = {'username': username}
+    if unset:
+        update['$unset'] = unset
+    try:
+        return await db_profile_updateone({'_id': uid}, update, upsert=upsert)
+    except DuplicateKeyError:
+        await db_profile_updateone({'username': username, '_id': {'$ne': uid}}, {'$unset': {'username': ''}}, many=True)
+        return await db_profile_updateone({'_id': uid}, update, upsert=upsert)
+
+async def db_profile_get_by_username(username):
+    return await profiles.find_one({'username': normalize_username(username)}, PROFILE_FIELDS)
+
+async def db_profile_register(uid, username):
+    # single atomic upsert, so two /start updates can't race into a duplicate insert;
+    # a user who sends /start can be reached again, so broadcasts stop skipping them
+    result = await _set_username(uid, normalize_username(username), upsert=True, unblock=True)
+    return result.upserted_id is not None
+
+async def db_profile_set(uid, **fields):
+    result = await db_profile_updateone({'_id': uid}, {'$set': fields})
+    return result.matched_count > 0
+
+async def db_profile_updateone(query, query2, upsert=False, many=False):
+    try:
+        if many:
+            return await profiles.update_many(query, query2)
+        return await profiles.update_one(query, query2, upsert=upsert)
+    finally:
+        uid = query.get('_id')
+        db_cache_invalidate(uid if uid is not None and not isinstance(uid, dict) else None)
+
+async def _next_id(name):
+    doc = await counters.find_one_and_update({'_id': name}, {'$inc': {'seq': 1}},
+                                             upsert=True, return_document=ReturnDocument.AFTER)
+    return doc['seq']
+
+async def db_ticket_create(uid, chat_id, username, text, media=()):
+    ticket = {
+        '_id': await _next_id('tickets'),
+        'user': uid,
+        'chat': chat_id,
+        'username': username,
+        'text': text,
+        'media': list(media),
+        'status': 'open',
+        'created': datetime.datetime.utcnow(),
+        'answered': None
+    }
+    await tickets.insert_one(ticket)
+    return ticket
+
+async def db_ticket_get(ticket_id):
+    return await tickets.find_one({'_id': ticket_id})
+
+async def db_ticket_get_by_staff_message(message_id):
+    # matches any message of a forwarded album
+    return await tickets.find_one({'staff_message_ids': message_id})
+
+async def db_ticket_set_staff_messages(ticket_id, message_ids):
+    return await tickets.update_one({'_id': ticket_id}, {'$set': {'staff_message_ids': list(message_ids)}})
+
+async def db_ticket_answer(ticket_id, staff_id):
+    # the first answer keeps its timestamp, so answer latency stays measurable
+    return await tickets.update_one({'_id': ticket_id, 'status': 'open'}, {'$set': {
+        'status': 'answered',
+        'answered': datetime.datetime.utcnow(),
+        'answered_by': staff_id
+    }})
+
+async def db_tickets_open(after=0, limit=10):
+    cursor = tickets.find({'status': 'open', '_id': {'$gt': after}},
+                          {'user': 1, 'username': 1, 'text': 1, 'media': 1, 'created': 1})
+    return await cursor.sort('_id', ASCENDING).limit(limit).to_list(limit)
+
+async def db_profiles_stream(after=None, batch=500):
+    # ids of everyone a broadcast should reach, in _id order so a checkpoint can resume the scan
+    query = {'ban': {'$ne': 1}, 'blocked': {'$ne': 1}}
+    if after is not None:
+        query['_id'] = {'$gt': after}
+    cursor = profiles.find(query, {'_id': 1}).sort('_id', ASCENDING).batch_size(batch)
+    async for doc in cursor:
+        yield doc['_id']
+
+async def db_profiles_mark_blocked(uids):
+    result = await profiles.update_many({'_id': {'$in': uids}}, {'$set': {'blocked': 1}})
+    for uid in uids:
+        db_cache_invalidate(uid)
+    return result
+
+async def db_broadcast_create(text, author):
+    broadcast = {
+        '_id': await _next_id('broadcasts'),
+        'text': text,
+        'author': author,
+        'status': 'running',
+        'last_uid': None,
+        'sent': 0,
+        'failed': 0,
+        'blocked': 0,
+        'created': datetime.datetime.utcnow(),
+        'finished': None
+    }
+    await broadcasts.insert_one(broadcast)
+    return broadcast
+
+async def db_broadcast_checkpoint(bid, last_uid, sent, failed, blocked):
+    return await broadcasts.update_one({'_id': bid}, {
+        '$set': {'last_uid': last_uid},
+        '$inc': {'sent': sent, 'failed': failed, 'blocked': blocked}
+    })
+
+async def db_broadcast_finish(bid, status):
+    return await broadcasts.find_one_and_update({'_id': bid}, {'$set': {
+        'status': status,
+        'finished': datetime.datetime.utcnow()
+    }}, return_document=ReturnDocument.AFTER)
 
-def db_profile_updateone(query, query2):
-    return profiles.update_one(query, query2)
+async def db_broadcasts_running():
+    return await broadcasts.find({'status': 'running'}).sort('_id', ASCENDING).to_list(None)
 
-def db_profile_get_usrname(username, get):
-    return profiles.find_one({'username': username})[get]
\ No newline at end of file
+async def db_broadcast_last():
+    found = await broadcasts.find({}).sort('_id', DESCENDING).limit(1).to_list(1)
+    return found[0] if found else None
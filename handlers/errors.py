@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import os
+import time
+import traceback
+
+from aiogram import types
+
+from bot import dp
+from configurebot import cfg
+from sender import sender, PRIORITY_STAFF
+
+log = logging.getLogger(__name__)
+
+errormessage = cfg['error_message']
+devid = cfg['dev_id']
+handlersdir = os.path.dirname(os.path.abspath(__file__))
+
+
+def fingerprint(error):
+    # the same exception raised from the same handler line is one problem, whatever chat it came from
+    frames = traceback.extract_tb(error.__traceback__)
+    ours = [f for f in frames if f.filename.startswith(handlersdir)]
+    frame = (ours or frames or [None])[-1]
+    where = f"{os.path.basename(frame.filename)}:{frame.lineno}" if frame is not None else '?'
+    return f"{type(error).__name__}@{where}"
+
+
+class ErrorDigest:
+    """
+    Groups handler exceptions by fingerprint and sends the developer one digest per interval.
+    The interval doubles while errors keep coming in bursts and resets once things calm down.
+    """
+
+    def __init__(self, interval, max_interval, storm, samples=5, groups=50):
+        self.base_interval = interval
+        self.interval = interval
+        self.max_interval = max_interval
+        self.storm = storm
+        self.samples = samples
+        self.groups = groups
+        self.pending = {}
+        self.dropped = 0
+        self.started = time.monotonic()
+
+    def record(self, error, chat_id=None):
+        key = fingerprint(error)
+        group = self.pending.get(key)
+        if group is None:
+            if len(self.pending) >= self.groups:
+                self.dropped += 1
+                return
+            group = self.pending[key] = {'text': str(error)[:200], 'count': 0, 'chats': []}
+        group['count'] += 1
+        if chat_id is not None and chat_id not in group['chats'] and len(group['chats']) < self.samples:
+            group['chats'].append(chat_id)
+
+    def render(self, limit=4000):
+        # whole groups only: a cut inside a `...` span would make Telegram reject the Markdown
+        minutes = max(1, round((time.monotonic() - self.started) / 60))
+        lines = [f"⚠ Сводка *ошибок* за {minutes} мин.:"]
+        # room for the closing line
+        size = len(lines[0]) + 60
+        dropped = self.dropped
+        full = False
+        for key, group in sorted(self.pending.items(), key=lambda item: -item[1]['count']):
+            text = group['text'].replace('`', "'")
+            chats = ', '.join(map(str, group['chats'])) or '—'
+            line = f"\n*{group['count']}×* `{key}`\n`{text}`\nЧаты: {chats}"
+            full = full or size + len(line) + 1 > limit
+            if full:
+                dropped += group['count']
+                continue
+            lines.append(line)
+            size += len(line) + 1
+        if dropped:
+            lines.append(f"\nИ ещё *{dropped}* ошибок других видов")
+        return '\n'.join(lines)
+
+    def flush(self):
+        if not self.pending and not self.dropped:
+            self.interval = self.base_interval
+            return
+        total = sum(g['count'] for g in self.pending.values()) + self.dropped
+        sender.send_message(devid, self.render(), priority=PRIORITY_STAFF, parse_mode='Markdown')
+        log.warning('Error digest: %s errors in %s groups', total, len(self.pending))
+        if total >= self.storm:
+            self.interval = min(self.interval * 2, self.max_interval)
+        else:
+            self.interval = self.base_interval
+        self.pending = {}
+        self.dropped = 0
+        self.started = time.monotonic()
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                self.flush()
+        finally:
+            self.flush()
+
+
+digest = ErrorDigest(interval=cfg['error_digest_interval'],
+                     max_interval=cfg['error_digest_max_interval'],
+                     storm=cfg['error_storm_threshold'])
+
+
+async def errors_handler(update: types.Update, error: Exception):
+    log.error('Update %s failed', update.update_id, exc_info=error)
+    message = update.message
+    digest.record(error, message.chat.id if message is not None else None)
+    if message is not None:
+        try:
+            await message.answer(f"{errormessage}", parse_mode='Markdown')
+        except Exception:
+            pass
+    return True
+
+def register_handler_errors():
+    dp.register_errors_handler(errors_handler)
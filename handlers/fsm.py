@@ -1,39 +1,127 @@
+import asyncio
+import time
+
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from bot import bot,dp
+from bot import dp
 from configurebot import cfg
+from sender import sender, PRIORITY_STAFF
+from handlers.db import db_ticket_create, db_ticket_set_staff_messages
 
 tehchatid = cfg['teh_chat_id']
 message_seneded = cfg['question_ur_question_sended_message']
 
+#keeps references to fire-and-forget tasks until they finish
+background = set()
+
 class FSMQuestion(StatesGroup):
 	text = State()
 
+class MediaGroups:
+	"""
+	Telegram delivers an album as separate messages sharing a media_group_id.
+	The first part waits until no new part has arrived for `window` seconds and returns the whole album,
+	later parts are only recorded and get None.
+	"""
+
+	def __init__(self, window):
+		self.window = window
+		self.groups = {}
+
+	async def collect(self, message):
+		key = (message.chat.id, message.media_group_id)
+		group = self.groups.get(key)
+		if group is not None:
+			group['parts'].append(message)
+			group['last'] = time.monotonic()
+			return None
+		group = self.groups[key] = {'parts': [message], 'last': time.monotonic()}
+		try:
+			while True:
+				wait = group['last'] + self.window - time.monotonic()
+				if wait <= 0:
+					break
+				await asyncio.sleep(wait)
+		finally:
+			del self.groups[key]
+		return sorted(group['parts'], key=lambda part: part.message_id)
+
+albums = MediaGroups(cfg['media_group_window'])
+
+def attachments(messages):
+	# the largest photo size, documents as they are; the same file sent twice is kept once
+	media = []
+	seen = set()
+	for message in messages:
+		if message.photo:
+			kind, attached = 'photo', message.photo[-1]
+		elif message.document:
+			kind, attached = 'document', message.document
+		else:
+			continue
+		if attached.file_unique_id in seen:
+			continue
+		seen.add(attached.file_unique_id)
+		media.append({'type': kind, 'file_id': attached.file_id})
+	return media
+
+def forward_question(text, media):
+	# albums can't mix photos with documents and hold 2-10 items, so files go out in as few calls as that allows
+	sent = []
+	for kind, send, item in (('photo', sender.send_photo, types.InputMediaPhoto),
+							 ('document', sender.send_document, types.InputMediaDocument)):
+		files = [m['file_id'] for m in media if m['type'] == kind]
+		for i in range(0, len(files), 10):
+			chunk = files[i:i + 10]
+			caption = {} if sent else {'caption': text, 'parse_mode': 'Markdown'}
+			if len(chunk) == 1:
+				sent.append(send(tehchatid, chunk[0], priority=PRIORITY_STAFF, **caption))
+			else:
+				group = [item(media=chunk[0], **caption)] + [item(media=file_id) for file_id in chunk[1:]]
+				sent.append(sender.send_media_group(tehchatid, group, priority=PRIORITY_STAFF))
+	if not sent:
+		sent.append(sender.send_message(tehchatid, text, priority=PRIORITY_STAFF, parse_mode='Markdown'))
+	return sent
+
 # Обработчики
 async def newquestion(message: types.Message, state: FSMContext):
-	async with state.proxy() as data:
-		if (message.content_type == 'photo'):
-			data['text'] = message.caption
-		else:
-			data['text'] = message.text
-	await state.finish()
+	if message.media_group_id is not None:
+		# the question stays open until the whole album is in
+		parts = await albums.collect(message)
+		if parts is None:
+			return
+	else:
+		parts = [message]
+	async with dp.storage.lock(chat=message.chat.id, user=message.from_user.id):
+		# another worker may have already taken this question
+		if await state.get_state() != FSMQuestion.text.state:
+			return
+		await state.finish()
 	if(message.chat.username == None):
 		who = "Ник не установлен"
 	else:
 		who = "@"+message.chat.username
-	question = data['text']
-	if(message.content_type=='photo'):
-		ph = message.photo[0].file_id
-		await message.reply(f"{message_seneded}",
-							parse_mode='Markdown')
-		await bot.send_photo(tehchatid, ph, caption=f"✉ | Новый вопрос\nОт: {who}\nВопрос: `{data['text']}`\n\n📝 Чтобы ответить на вопрос введите `/ответ {message.chat.id} Ваш ответ`",parse_mode='Markdown')
-	else:
-		await message.reply(f"{message_seneded}",
-							parse_mode='Markdown')
-		await bot.send_message(tehchatid,
-							   f"✉ | Новый вопрос\nОт: {who}\nВопрос: `{data['text']}`\n\n📝 Чтобы ответить на вопрос введите `/ответ {message.chat.id} Ваш ответ`",
-							   parse_mode='Markdown')
+	question = next((part.text or part.caption for part in parts if part.text or part.caption), None)
+	media = attachments(parts)
+	await message.reply(f"{message_seneded}",
+						parse_mode='Markdown')
+	ticket = await db_ticket_create(message.from_user.id, message.chat.id, message.chat.username, question, media)
+	tid = ticket['_id']
+	text = f"✉ | Новый вопрос *#{tid}*\nОт: {who}\nВопрос: `{question}`\n\n📝 Чтобы ответить, ответьте на это сообщение или введите `/ответ #{tid} Ваш ответ`"
+	task = asyncio.create_task(remember_staff_messages(tid, forward_question(text, media)))
+	background.add(task)
+	task.add_done_callback(background.discard)
+
+async def remember_staff_messages(tid, sent):
+	# lets staff answer by replying to any part of the forwarded question
+	ids = []
+	for result in await asyncio.gather(*sent, return_exceptions=True):
+		if isinstance(result, BaseException):
+			continue
+		ids.extend(m.message_id for m in (result if isinstance(result, list) else [result]))
+	if ids:
+		await db_ticket_set_staff_messages(tid, ids)
 
 def register_handler_FSM():
-	dp.register_message_handler(newquestion,state=FSMQuestion.text, content_types=['photo', 'text'])
\ No newline at end of file
+	dp.register_message_handler(newquestion,state=FSMQuestion.text, content_types=['photo', 'document', 'text'])
@@ -1,9 +1,53 @@
-from .bot import dp, bot
-from aiogram.utils import executor
-from .handlers import client, admin, fsm
+from bot import dp, bot
+from handlers import client, admin, fsm, db, errors, broadcast
+from configurebot import cfg
+import asyncio
+import logging
 
+import metrics
+import router
+import server
+import throttle
+from sender import sender
+
+logging.basicConfig(level=logging.INFO)
+
+router.register_handler_router()
 admin.register_handler_admin()
+broadcast.register_handler_broadcast()
 fsm.register_handler_FSM()
 client.register_handler_client()
+errors.register_handler_errors()
+
+dp.middleware.setup(server.inflight)
+dp.middleware.setup(throttle.middleware)
+dp.middleware.setup(router.AccessMiddleware(db.db_profile_access))
+
+background = []
+
+async def on_startup(dp):
+    await db.db_ensure_indexes()
+    sender.start()
+    await broadcast.broadcaster.resume()
+    if cfg['mode'] == 'webhook':
+        await server.set_webhook(bot)
+    if cfg['metrics_port']:
+        await metrics.serve(cfg['metrics_host'], cfg['metrics_port'])
+    background.append(asyncio.create_task(errors.digest.run()))
+    if cfg['metrics_log_interval']:
+        background.append(asyncio.create_task(metrics.log_periodically(cfg['metrics_log_interval'])))
+
+async def on_shutdown(dp):
+    await server.drain(dp)
+    await broadcast.broadcaster.stop(cfg['shutdown_timeout'])
+    # cancelling the digest task flushes pending errors into the send queue before it drains
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    await sender.close(cfg['shutdown_timeout'])
 
-executor.start_polling(dp, skip_updates=True)
\ No newline at end of file
+if __name__ == '__main__':
+    if cfg['mode'] == 'webhook':
+        server.start_webhook(dp, on_startup, on_shutdown)
+    else:
+        server.start_polling(dp, on_startup, on_shutdown)
\ No newline at end of file
@@ -0,0 +1,237 @@
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from bisect import bisect_left
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+log = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def inc(self, *labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.doc}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in self.values.items():
+            yield f'{self.name}{_labels(self.labels, labels)} {value}'
+
+
+class Gauge(Counter):
+    def set(self, *labels, value):
+        self.values[labels] = value
+
+    def render(self):
+        for line in super().render():
+            yield line.replace(' counter', ' gauge') if line.startswith('# TYPE') else line
+
+
+class Histogram:
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        #labels -> [bucket counts..., +Inf count, sum]
+        self.values = {}
+        registry.append(self)
+
+    def observe(self, seconds, *labels):
+        value = self.values.get(labels)
+        if value is None:
+            value = self.values[labels] = [0] * (len(BUCKETS) + 1) + [0.0]
+        value[bisect_left(BUCKETS, seconds)] += 1
+        value[-1] += seconds
+
+    def count(self, *labels):
+        value = self.values.get(labels)
+        return sum(value[:-1]) if value else 0
+
+    def quantile(self, q, *labels):
+        # upper bound of the bucket holding the q-th observation
+        value = self.values.get(labels)
+        if not value:
+            return 0
+        rank = q * sum(value[:-1])
+        seen = 0
+        for bound, n in zip(BUCKETS + (float('inf'),), value[:-1]):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        yield f'# HELP {self.name} {self.doc}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, value in self.values.items():
+            seen = 0
+            for bound, n in zip(BUCKETS + ('+Inf',), value[:-1]):
+                seen += n
+                yield f'{self.name}_bucket{_labels(self.labels + ("le",), labels + (bound,))} {seen}'
+            yield f'{self.name}_sum{_labels(self.labels, labels)} {value[-1]}'
+            yield f'{self.name}_count{_labels(self.labels, labels)} {seen}'
+
+
+updates = Counter('bot_updates_total', 'Updates received', ('type',))
+handler_seconds = Histogram('bot_handler_seconds', 'Handler latency', ('handler',))
+handler_errors = Counter('bot_handler_errors_total', 'Exceptions raised by handlers', ('handler', 'error'))
+db_calls = Counter('bot_db_calls_total', 'Database calls', ('collection', 'op'))
+handler_db_calls = Counter('bot_handler_db_calls_total', 'Database calls by the handler that made them', ('handler',))
+db_seconds = Histogram('bot_db_seconds', 'Database call latency', ('collection', 'op'))
+db_errors = Counter('bot_db_errors_total', 'Failed database calls', ('collection', 'op'))
+api_seconds = Histogram('bot_api_seconds', 'Telegram Bot API call latency', ('method',))
+api_errors = Counter('bot_api_errors_total', 'Failed Telegram Bot API calls', ('method', 'error'))
+send_queue_depth = Gauge('bot_send_queue_depth', 'Messages waiting in the outbound queue')
+broadcast_messages = Counter('bot_broadcast_messages_total', 'Broadcast deliveries', ('result',))
+send_seconds = Histogram('bot_send_queue_seconds', 'Time from enqueueing a message to delivering it')
+throttled = Counter('bot_throttled_total', 'Messages dropped by flood control', ('key',))
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    # compact view for the periodic log line
+    return {
+        'updates': sum(updates.values.values()),
+        'handlers': {labels[0]: {'count': handler_seconds.count(*labels),
+                                 'p50': handler_seconds.quantile(0.5, *labels),
+                                 'p99': handler_seconds.quantile(0.99, *labels)}
+                     for labels in handler_seconds.values},
+        'handler_errors': sum(handler_errors.values.values()),
+        'db_calls': sum(db_calls.values.values()),
+        'api_calls': sum(api_seconds.count(*labels) for labels in api_seconds.values),
+        'send_queue_depth': send_queue_depth.values.get((), 0),
+    }
+
+
+#'unknown' until a handler is picked, i.e. during filters and pre-process middlewares
+_handler = contextvars.ContextVar('metrics_handler', default='unknown')
+
+
+def name_handler(name):
+    # lets a dispatching handler report the function it actually routed to
+    _handler.set(name)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update, data):
+        for kind in ('message', 'callback_query', 'edited_message', 'my_chat_member'):
+            if getattr(update, kind) is not None:
+                updates.inc(kind)
+                return
+        updates.inc('other')
+
+    async def on_process_message(self, message, data):
+        handler = current_handler.get()
+        _handler.set(handler.__name__)
+        data['_metrics_start'] = time.perf_counter()
+
+    async def on_post_process_message(self, message, results, data):
+        start = data.get('_metrics_start')
+        if start is not None:
+            handler_seconds.observe(time.perf_counter() - start, _handler.get())
+
+    async def on_pre_process_error(self, update, error, data):
+        handler_errors.inc(_handler.get(), type(error).__name__)
+
+
+class InstrumentedCollection:
+    # times every awaited call on a data layer collection
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        if name == 'find':
+            # cursors are consumed lazily, so only the call itself is counted
+            db_calls.inc(self._collection.name, name)
+            handler_db_calls.inc(_handler.get())
+            return attr
+
+        async def timed(*args, **kwargs):
+            db_calls.inc(self._collection.name, name)
+            handler_db_calls.inc(_handler.get())
+            start = time.perf_counter()
+            try:
+                return await attr(*args, **kwargs)
+            except Exception:
+                db_errors.inc(self._collection.name, name)
+                raise
+            finally:
+                db_seconds.observe(time.perf_counter() - start, self._collection.name, name)
+        return timed
+
+
+class InstrumentedDatabase:
+    def __init__(self, database):
+        self._database = database
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = InstrumentedCollection(self._database[name])
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+
+class InstrumentedBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            api_errors.inc(method, type(e).__name__)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - start, method)
+
+
+async def metrics_view(request):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+async def log_periodically(interval):
+    while True:
+        await asyncio.sleep(interval)
+        log.info(json.dumps(snapshot()))
+
+
+async def serve(host, port):
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
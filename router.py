@@ -0,0 +1,123 @@
+from types import SimpleNamespace
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from bot import dp, bot
+import metrics
+
+
+class Arg:
+    def __init__(self, name, type=str, optional=False, default=None, rest=False):
+        self.name = name
+        self.type = type
+        self.optional = optional
+        self.default = default
+        self.rest = rest
+
+
+def Rest(name, optional=False):
+    # everything after the other arguments, spacing and line breaks kept
+    return Arg(name, optional=optional, default='', rest=True)
+
+
+def ticket_id(value):
+    return int(value.lstrip('#'))
+
+
+class Route:
+    def __init__(self, handler, names, args, access, usage):
+        self.handler = handler
+        self.names = names
+        self.args = args
+        self.access = access
+        self.usage = usage
+        self.fixed = [arg for arg in args if not arg.rest]
+        self.rest = args[-1] if args and args[-1].rest else None
+
+    def parse(self, text):
+        # raises ValueError when the arguments don't fit the schema
+        if not self.args:
+            # commands without arguments ignore what follows, e.g. a /start deep link payload
+            return SimpleNamespace()
+        n = len(self.fixed)
+        parts = text.split(maxsplit=n) if self.rest is not None else text.split()
+        if len(parts) > n and self.rest is None:
+            raise ValueError('too many arguments')
+        values = {}
+        for i, arg in enumerate(self.fixed):
+            if i < len(parts):
+                values[arg.name] = arg.type(parts[i])
+            elif arg.optional:
+                values[arg.name] = arg.default
+            else:
+                raise ValueError(f'{arg.name} is missing')
+        if self.rest is not None:
+            rest = parts[n] if len(parts) > n else ''
+            if not rest and not self.rest.optional:
+                raise ValueError(f'{self.rest.name} is missing')
+            values[self.rest.name] = rest
+        return SimpleNamespace(**values)
+
+
+#command name and every alias -> Route, filled by the register_handler_* functions
+routes = {}
+
+
+def command(names, handler, args=(), access=0, usage=None):
+    if args and usage is None:
+        raise ValueError(f'/{names[0]} takes arguments, so it needs a usage example')
+    route = Route(handler, names, list(args), access, usage)
+    for name in names:
+        routes[name.lower()] = route
+
+
+async def route_filter(message: types.Message):
+    if not message.is_command():
+        return False
+    name, _, mention = message.text.split(maxsplit=1)[0][1:].partition('@')
+    route = routes.get(name.lower())
+    if route is None:
+        return False
+    if mention and mention.lower() != (await bot.me).username.lower():
+        return False
+    return {'route': route}
+
+
+class AccessMiddleware(BaseMiddleware):
+    """
+    Checks the access level and parses the arguments of routed commands before they reach the handler,
+    so handlers only see staff that may run them and arguments that fit the schema.
+
+    get_access is a coroutine function returning a user's access level; it's passed in
+    because the data layer lives in the handlers package, which registers its commands here.
+    """
+
+    def __init__(self, get_access):
+        super().__init__()
+        self.get_access = get_access
+
+    async def on_process_message(self, message, data):
+        route = data.get('route')
+        if route is None:
+            return
+        metrics.name_handler(route.handler.__name__)
+        if route.access and await self.get_access(message.from_user.id) < route.access:
+            raise CancelHandler()
+        try:
+            data['args'] = route.parse(message.get_args() or '')
+        except ValueError:
+            await message.reply(f'⚠ Укажите аргументы команды\nПример: {route.usage}', parse_mode='Markdown')
+            raise CancelHandler()
+
+
+async def dispatch(message: types.Message, route, args):
+    if route.args:
+        await route.handler(message, args)
+    else:
+        await route.handler(message)
+
+
+def register_handler_router():
+    dp.register_message_handler(dispatch, route_filter)
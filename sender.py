@@ -0,0 +1,240 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+
+from aiogram.utils.exceptions import RetryAfter, NetworkError, RestartingTelegram
+
+from bot import bot
+from configurebot import cfg
+import metrics
+
+log = logging.getLogger(__name__)
+
+#lower goes first: answers to users overtake staff notifications, broadcasts yield to both
+PRIORITY_USER = 0
+PRIORITY_STAFF = 1
+PRIORITY_BULK = 2
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        # returns 0 and spends a token, or how many seconds to wait for one
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self):
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+
+class Job:
+    __slots__ = ('method', 'chat_id', 'args', 'kwargs', 'future', 'created', 'attempts')
+
+    def __init__(self, method, chat_id, args, kwargs, future):
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.created = time.monotonic()
+        self.attempts = 0
+
+
+def _consume(future):
+    # errors are logged by the worker; callers that don't await the result shouldn't get warnings
+    if not future.cancelled():
+        future.exception()
+
+
+class Sender:
+    """
+    Outbound Telegram queue: every send goes through a global and a per-chat token bucket,
+    RetryAfter pauses the chat and puts the message back, and a fixed number of workers bounds concurrency.
+    """
+
+    def __init__(self, bot, workers, global_rate, chat_rate, group_rate, retries):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.retries = retries
+        self.queue = asyncio.PriorityQueue()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self._seq = itertools.count()
+        self._handled = itertools.count(1)
+        self._tasks = []
+        self._delayed = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latencies = deque(maxlen=1000)
+
+    def send(self, method, chat_id, *args, priority=PRIORITY_USER, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume)
+        self._put(priority, Job(method, chat_id, args, kwargs, future))
+        return future
+
+    def send_message(self, chat_id, text, priority=PRIORITY_USER, **kwargs):
+        return self.send('send_message', chat_id, text, priority=priority, **kwargs)
+
+    def send_photo(self, chat_id, photo, priority=PRIORITY_USER, **kwargs):
+        return self.send('send_photo', chat_id, photo, priority=priority, **kwargs)
+
+    def send_document(self, chat_id, document, priority=PRIORITY_USER, **kwargs):
+        return self.send('send_document', chat_id, document, priority=priority, **kwargs)
+
+    def send_media_group(self, chat_id, media, priority=PRIORITY_USER, **kwargs):
+        # one API call and one token for up to 10 items, resolves to the list of sent messages
+        return self.send('send_media_group', chat_id, media, priority=priority, **kwargs)
+
+    def _put(self, priority, job, delay=0):
+        item = (priority, next(self._seq), job)
+        if not delay:
+            self.queue.put_nowait(item)
+        else:
+            self._delayed += 1
+            asyncio.get_running_loop().call_later(delay, self._put_delayed, item)
+        self._update_depth()
+
+    def _put_delayed(self, item):
+        self._delayed -= 1
+        self.queue.put_nowait(item)
+
+    def _update_depth(self):
+        metrics.send_queue_depth.set(value=self.queue.qsize() + self._delayed)
+
+    def _chat_bucket(self, chat_id):
+        key = str(chat_id)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            # groups and channels get a much lower limit than private chats
+            rate = self.group_rate if key.startswith(('-', '@')) else self.chat_rate
+            bucket = self.chat_buckets[key] = TokenBucket(rate, max(1, rate))
+        return bucket
+
+    def _prune(self):
+        for chat_id in [c for c, b in self.chat_buckets.items() if b.idle()]:
+            del self.chat_buckets[chat_id]
+
+    async def _worker(self):
+        while True:
+            priority, _, job = await self.queue.get()
+            self._update_depth()
+            try:
+                wait = self._chat_bucket(job.chat_id).take()
+                if wait:
+                    # don't hold a worker for one busy chat
+                    self._put(priority, job, wait)
+                    continue
+                while True:
+                    wait = self.global_bucket.take()
+                    if not wait:
+                        break
+                    await asyncio.sleep(wait)
+                await self._call(priority, job)
+            finally:
+                self.queue.task_done()
+            if next(self._handled) % 1000 == 0:
+                self._prune()
+
+    async def _call(self, priority, job):
+        job.attempts += 1
+        self.in_flight += 1
+        try:
+            result = await getattr(self.bot, job.method)(job.chat_id, *job.args, **job.kwargs)
+        except RetryAfter as e:
+            self._chat_bucket(job.chat_id).pause(e.timeout)
+            self._retry(priority, job, e, e.timeout)
+        except (NetworkError, RestartingTelegram) as e:
+            self._retry(priority, job, e, 2 ** job.attempts)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.sent += 1
+            self.latencies.append(time.monotonic() - job.created)
+            metrics.send_seconds.observe(self.latencies[-1])
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self.in_flight -= 1
+
+    def _retry(self, priority, job, error, delay):
+        if job.attempts > self.retries:
+            self._fail(job, error)
+            return
+        self.retried += 1
+        self._put(priority, job, delay)
+
+    def _fail(self, job, error):
+        self.failed += 1
+        log.warning('%s to %s failed: %r', job.method, job.chat_id, error)
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0
+        return {
+            'queue_depth': self.queue.qsize() + self._delayed,
+            'in_flight': self.in_flight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'latency_p50': percentile(0.5),
+            'latency_p99': percentile(0.99),
+        }
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _drain(self):
+        while True:
+            await self.queue.join()
+            if not self._delayed:
+                return
+            await asyncio.sleep(0.1)
+
+    async def close(self, timeout):
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            log.warning('Shutdown timeout: %s messages left unsent', self.queue.qsize() + self._delayed)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+sender = Sender(bot,
+                workers=cfg['send_concurrency'],
+                global_rate=cfg['send_global_rate'],
+                chat_rate=cfg['send_chat_rate'],
+                group_rate=cfg['send_group_rate'],
+                retries=cfg['send_retries'])
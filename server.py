@@ -0,0 +1,82 @@
+import asyncio
+import logging
+
+from aiohttp import web
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils import executor
+
+from configurebot import cfg
+
+log = logging.getLogger(__name__)
+
+
+class InFlightMiddleware(BaseMiddleware):
+    # counts updates that are being handled, so shutdown can wait for them to finish
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self._idle = None
+
+    @property
+    def idle(self):
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            self._idle.set()
+        return self._idle
+
+    async def on_pre_process_update(self, update, data):
+        self.count += 1
+        self.idle.clear()
+
+    async def on_post_process_update(self, update, result, data):
+        self.count -= 1
+        if self.count == 0:
+            self.idle.set()
+
+    async def wait_idle(self, timeout):
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            log.warning('Shutdown timeout: %s updates still in flight', self.count)
+
+
+inflight = InFlightMiddleware()
+
+
+async def health(request):
+    return web.json_response({'status': 'ok', 'in_flight': inflight.count})
+
+
+def make_app():
+    app = web.Application()
+    app.router.add_get('/health', health)
+    return app
+
+
+async def set_webhook(bot):
+    await bot.set_webhook(cfg['webhook_url'] + cfg['webhook_path'],
+                          max_connections=cfg['webhook_max_connections'],
+                          drop_pending_updates=cfg['skip_updates'])
+
+
+async def drain(dp):
+    # stop taking new updates, then let the ones already being handled finish
+    dp.stop_polling()
+    await inflight.wait_idle(cfg['shutdown_timeout'])
+
+
+def make_webhook(dp, on_startup, on_shutdown):
+    # the webhook route is served next to /health; metrics stay on metrics_host, this listener is public
+    return executor.set_webhook(dp, cfg['webhook_path'], on_startup=on_startup,
+                                on_shutdown=on_shutdown, web_app=make_app())
+
+
+def start_webhook(dp, on_startup, on_shutdown):
+    webhook = make_webhook(dp, on_startup, on_shutdown)
+    webhook.run_app(host=cfg['webapp_host'], port=cfg['webapp_port'],
+                    shutdown_timeout=cfg['shutdown_timeout'])
+
+
+def start_polling(dp, on_startup, on_shutdown):
+    executor.start_polling(dp, skip_updates=cfg['skip_updates'],
+                           on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,115 @@
+import asyncio
+import copy
+import datetime
+import uuid
+from contextlib import asynccontextmanager
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from database import get_database, DuplicateKeyError
+
+
+class MongoStorage(BaseStorage):
+    """
+    FSM storage kept in the bot database, so states survive restarts and are shared by all bot workers.
+
+    Every write is a single-document update, idle states expire after ``ttl`` seconds
+    (TTL index on ``updated``, also checked on read) and ``lock()`` serialises work on one chat across workers.
+    """
+
+    def __init__(self, ttl, lock_timeout=30):
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.lock_timeout = datetime.timedelta(seconds=lock_timeout)
+        db = get_database()
+        self.states = db['fsm']
+        self.leases = db['fsm_locks']
+        #key -> [asyncio.Lock, users]
+        self._locks = {}
+
+    async def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return f'{chat}:{user}'
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.utcnow()
+
+    async def _get(self, key):
+        doc = await self.states.find_one({'_id': key})
+        if doc is None:
+            return {}
+        if doc['updated'] < self._now() - self.ttl:
+            await self.states.delete_one({'_id': key, 'updated': doc['updated']})
+            return {}
+        return doc
+
+    async def _write(self, key, fields, unset=()):
+        update = {'$set': {**fields, 'updated': self._now()}}
+        if unset:
+            update['$unset'] = dict.fromkeys(unset, '')
+        await self.states.update_one({'_id': key}, update, upsert=True)
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        doc = await self._get(self._key(chat, user))
+        return doc.get('state', self.resolve_state(default))
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        doc = await self._get(self._key(chat, user))
+        return doc.get('data', copy.deepcopy(default) or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        state = self.resolve_state(state)
+        key = self._key(chat, user)
+        if state is None:
+            await self._write(key, {}, unset=['state'])
+        else:
+            await self._write(key, {'state': state})
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await self._write(self._key(chat, user), {'data': copy.deepcopy(data or {})})
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        data = {**(data or {}), **kwargs}
+        if data:
+            await self._write(self._key(chat, user), {f'data.{k}': v for k, v in data.items()})
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        if with_data:
+            # nothing else is kept per chat, so a finished conversation leaves no document behind
+            await self.states.delete_one({'_id': self._key(chat, user)})
+        else:
+            await self.set_state(chat=chat, user=user, state=None)
+
+    @asynccontextmanager
+    async def lock(self, *, chat=None, user=None):
+        key = self._key(chat, user)
+        local = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        local[1] += 1
+        try:
+            # waiters in this process queue on the asyncio lock, only the holder polls the shared lease
+            async with local[0]:
+                token = uuid.uuid4().hex
+                await self._acquire(key, token)
+                try:
+                    yield
+                finally:
+                    await self.leases.delete_one({'_id': key, 'owner': token})
+        finally:
+            local[1] -= 1
+            if not local[1]:
+                del self._locks[key]
+
+    async def _acquire(self, key, token):
+        while True:
+            try:
+                await self.leases.insert_one({'_id': key, 'owner': token, 'expires': self._now() + self.lock_timeout})
+                return
+            except DuplicateKeyError:
+                await self.leases.delete_one({'_id': key, 'expires': {'$lt': self._now()}})
+                await asyncio.sleep(0.05)
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import configurebot
+
+# modules read cfg when they are imported, so this has to happen first
+configurebot.cfg.update({
+    'token': '123456:test',
+    'db_backend': 'memory',
+    'teh_chat_id': -100,
+    'dev_id': 1,
+})
+
+from database import ASCENDING, get_database
+
+
+@pytest.fixture
+def database():
+    # every test starts from empty collections; handlers keep references to them, so they are emptied, not replaced
+    from handlers.db import db_cache_invalidate
+    memory = get_database()
+    for collection in memory.collections.values():
+        collection.docs.clear()
+        collection.indexes = {'_id_': {'key': [('_id', ASCENDING)]}}
+    db_cache_invalidate()
+    return memory
+
+
+@pytest.fixture
+def bot_api(monkeypatch):
+    # every Bot API request is recorded and answered like Telegram would, nothing leaves the process
+    import itertools
+    from aiogram import Bot
+    requests = []
+    message_ids = itertools.count(1)
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        requests.append((method, dict(data or {})))
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Test', 'username': 'test_bot'}
+        if method.startswith('send'):
+            return {'message_id': next(message_ids), 'date': 0,
+                    'chat': {'id': int(data['chat_id']), 'type': 'private'}}
+        return True
+
+    monkeypatch.setattr(Bot, 'request', request)
+    return requests
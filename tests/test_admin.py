@@ -0,0 +1,79 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import BotBlocked
+
+from bot import bot
+from handlers import admin, db
+from sender import Sender
+
+STAFF = 9
+USER = 5
+
+
+class FakeBot:
+    # the user in `blocked` has blocked the bot, everyone else gets the message
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.delivered = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if int(chat_id) in self.blocked:
+            raise BotBlocked('Forbidden: bot was blocked by the user')
+        self.delivered.append(int(chat_id))
+
+
+def staff_message(text):
+    return types.Message(**{'message_id': 1, 'date': 0, 'text': text,
+                            'chat': {'id': -100, 'type': 'supergroup'},
+                            'from': {'id': STAFF, 'is_bot': False, 'first_name': 'Staff'}})
+
+
+def answer(monkeypatch, fake, text):
+    async def scenario():
+        Bot.set_current(bot)
+        sender = Sender(fake, workers=1, global_rate=1000, chat_rate=1000, group_rate=1000, retries=0)
+        monkeypatch.setattr(admin, 'sender', sender)
+        sender.start()
+        ticket = await db.db_ticket_create(USER, USER, 'ivan', 'Вопрос')
+        await admin.admin_ot(staff_message(text), SimpleNamespace(text=f"#{ticket['_id']} Ответ"))
+        await sender.close(1)
+        return await db.db_ticket_get(ticket['_id'])
+    return asyncio.run(scenario())
+
+
+def replies(bot_api):
+    return [data['text'] for method, data in bot_api if method == 'sendMessage']
+
+
+def test_answer_is_delivered_before_the_ticket_closes(database, bot_api, monkeypatch):
+    fake = FakeBot()
+    ticket = answer(monkeypatch, fake, '/ответ')
+    assert fake.delivered == [USER]
+    assert ticket['status'] == 'answered' and ticket['answered_by'] == STAFF
+    assert replies(bot_api) == ['✅ Вы успешно ответили на вопрос!']
+
+
+def test_undelivered_answer_keeps_the_ticket_open(database, bot_api, monkeypatch):
+    fake = FakeBot(blocked=[USER])
+    ticket = answer(monkeypatch, fake, '/ответ')
+    assert ticket['status'] == 'open'
+    (reply,) = replies(bot_api)
+    assert reply.startswith('⚠ Сообщение пользователю *не* доставлено')
+
+
+def test_ticket_page_keeps_markdown_balanced(database, bot_api):
+    async def scenario():
+        Bot.set_current(bot)
+        await db.db_ticket_create(USER, USER, 'ivan_petrov', 'Почему `pip` не ставит пакет?')
+        await db.db_ticket_create(USER + 1, USER + 1, None, 'Вопрос')
+        await admin.admin_tickets(staff_message('/вопросы'), SimpleNamespace(after=0))
+
+    asyncio.run(scenario())
+    (page,) = replies(bot_api)
+    assert '`@ivan_petrov`' in page and "'pip'" in page
+    # outside code spans every Markdown marker is paired
+    outside = page.split('`')[::2]
+    assert page.count('`') % 2 == 0
+    assert all(part.count('_') % 2 == 0 and part.count('*') % 2 == 0 for part in outside)
@@ -0,0 +1,88 @@
+import asyncio
+
+from aiogram import types
+
+from handlers import fsm
+from handlers.fsm import MediaGroups, attachments, forward_question
+
+
+def part(message_id, photo=None, document=None, media_group_id='album'):
+    message = {'message_id': message_id, 'date': 0, 'media_group_id': media_group_id,
+               'chat': {'id': 5, 'type': 'private'}}
+    if photo is not None:
+        # two sizes of the same picture, the largest last like Telegram sends them
+        message['photo'] = [{'file_id': f'{photo}_small', 'file_unique_id': f'{photo}_small', 'width': 90, 'height': 90},
+                            {'file_id': photo, 'file_unique_id': photo, 'width': 1280, 'height': 1280}]
+    if document is not None:
+        message['document'] = {'file_id': document, 'file_unique_id': document}
+    return types.Message(**message)
+
+
+class Recorder:
+    # stands in for the send queue and remembers what would have been sent
+    def __init__(self):
+        self.calls = []
+
+    def _record(self, method):
+        def send(chat_id, payload, **kwargs):
+            self.calls.append((method, chat_id, payload, kwargs))
+            return method
+        return send
+
+    def __getattr__(self, method):
+        return self._record(method)
+
+
+def test_album_is_collected_by_its_first_part():
+    async def scenario():
+        groups = MediaGroups(0.1)
+        first = asyncio.create_task(groups.collect(part(2, photo='b')))
+        await asyncio.sleep(0.05)
+        later = [await groups.collect(part(3, photo='c')), await groups.collect(part(1, photo='a'))]
+        # another chat's album with the same id is a separate group
+        other = asyncio.create_task(groups.collect(types.Message(**{
+            'message_id': 9, 'date': 0, 'media_group_id': 'album', 'chat': {'id': 6, 'type': 'private'}})))
+        return await first, later, await other, groups.groups
+
+    parts, later, other, pending = asyncio.run(scenario())
+    assert [p.message_id for p in parts] == [1, 2, 3]
+    assert later == [None, None]
+    assert [p.message_id for p in other] == [9]
+    assert pending == {}
+
+
+def test_attachments_keep_the_largest_photo_once():
+    messages = [part(1, photo='a'), part(2, photo='a'), part(3, document='d'), part(4, document='d'),
+                types.Message(**{'message_id': 5, 'date': 0, 'text': 'hi', 'chat': {'id': 5, 'type': 'private'}})]
+    assert attachments(messages) == [{'type': 'photo', 'file_id': 'a'}, {'type': 'document', 'file_id': 'd'}]
+
+
+def test_files_are_sent_in_albums_of_ten(monkeypatch):
+    recorder = Recorder()
+    monkeypatch.setattr(fsm, 'sender', recorder)
+    media = [{'type': 'photo', 'file_id': f'p{i}'} for i in range(11)] + \
+            [{'type': 'document', 'file_id': f'd{i}'} for i in range(3)]
+    sent = forward_question('question', media)
+
+    assert [call[0] for call in recorder.calls] == ['send_media_group', 'send_photo', 'send_media_group']
+    album, photo, documents = recorder.calls
+    assert [item.media for item in album[2]] == [f'p{i}' for i in range(10)]
+    # only the first item sent carries the question
+    assert album[2][0].caption == 'question'
+    assert all(item.caption is None for item in album[2][1:])
+    assert photo[2] == 'p10' and 'caption' not in photo[3]
+    assert [item.media for item in documents[2]] == ['d0', 'd1', 'd2']
+    assert all(item.caption is None for item in documents[2])
+    assert {call[1] for call in recorder.calls} == {fsm.tehchatid}
+    assert len(sent) == 3
+
+
+def test_single_file_and_text_only_questions(monkeypatch):
+    recorder = Recorder()
+    monkeypatch.setattr(fsm, 'sender', recorder)
+    forward_question('question', [{'type': 'document', 'file_id': 'd0'}])
+    forward_question('question', [])
+
+    (single, text) = recorder.calls
+    assert single[:3] == ('send_document', fsm.tehchatid, 'd0') and single[3]['caption'] == 'question'
+    assert text[:3] == ('send_message', fsm.tehchatid, 'question')
@@ -0,0 +1,68 @@
+import asyncio
+from collections import Counter
+
+from aiogram.utils.exceptions import BotBlocked
+
+from handlers import broadcast, db
+from sender import Sender
+
+AUTHOR = 1
+BLOCKS_THE_BOT = 17
+
+
+class FakeBot:
+    # delivers instantly, except to the one user who blocked the bot; holds every send after
+    # the first `hold_after` until `released` is set, so the test can stop a run midway
+    def __init__(self, hold_after):
+        self.deliveries = Counter()
+        self.hold_after = hold_after
+        self.held = asyncio.Event()
+        self.released = asyncio.Event()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if sum(self.deliveries.values()) >= self.hold_after:
+            self.held.set()
+            await self.released.wait()
+        if chat_id == BLOCKS_THE_BOT:
+            raise BotBlocked('Forbidden: bot was blocked by the user')
+        self.deliveries[chat_id] += 1
+
+
+def test_stopped_broadcast_resumes_without_duplicates(database, monkeypatch):
+    profiles = database['profiles']
+    banned, blocked = {5, 23, 41}, {8, 30}
+    for uid in range(10, 70):
+        asyncio.run(profiles.insert_one({'_id': uid, 'access': 0, 'ban': int(uid in banned),
+                                         'blocked': int(uid in blocked)}))
+    eligible = set(range(10, 70)) - banned - blocked - {BLOCKS_THE_BOT}
+    async def scenario():
+        bot = FakeBot(hold_after=15)
+        sender = Sender(bot, workers=4, global_rate=1000, chat_rate=1000, group_rate=1000, retries=0)
+        monkeypatch.setattr(broadcast, 'sender', sender)
+        sender.start()
+        first = broadcast.Broadcaster(rate=1000, batch=10)
+        first.start(await db.db_broadcast_create('Оплата до 25 числа', AUTHOR))
+        await bot.held.wait()
+        # a restart in the middle of the run
+        stopping = asyncio.create_task(first.stop(5))
+        await asyncio.sleep(0)
+        bot.released.set()
+        await stopping
+        stopped = await db.db_broadcast_last()
+
+        second = broadcast.Broadcaster(rate=1000, batch=10)
+        await second.resume()
+        await asyncio.gather(*second.tasks.values())
+        await sender.close(1)
+        return bot, stopped, await db.db_broadcast_last()
+
+    bot, stopped, finished = asyncio.run(scenario())
+    assert stopped['status'] == 'running' and stopped['last_uid'] is not None
+    assert max(bot.deliveries) > stopped['last_uid']
+    assert set(bot.deliveries) - {AUTHOR} == eligible
+    assert all(n == 1 for uid, n in bot.deliveries.items() if uid != AUTHOR)
+    # the author is told once, when the broadcast is done
+    assert bot.deliveries[AUTHOR] == 1
+    assert (finished['status'], finished['sent'], finished['blocked'], finished['failed']) == \
+        ('done', len(eligible), 1, 0)
+    assert asyncio.run(profiles.find_one({'_id': BLOCKS_THE_BOT}))['blocked'] == 1
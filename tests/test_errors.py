@@ -0,0 +1,29 @@
+import re
+
+from handlers.errors import ErrorDigest
+
+
+def storm(groups, dropped=0):
+    digest = ErrorDigest(interval=60, max_interval=600, storm=100)
+    for i in range(groups):
+        digest.pending[f'KeyError@handler_{i}.py:{i}'] = {
+            'text': f"'`field_{i}`' " + 'x' * 180, 'count': i + 1, 'chats': [100 + i, 200 + i]}
+    digest.dropped = dropped
+    return digest
+
+
+def test_digest_fits_one_message_with_balanced_markdown():
+    digest = storm(40, dropped=7)
+    text = digest.render()
+    assert len(text) <= 4000
+    assert text.count('`') % 2 == 0 and text.count('*') % 2 == 0
+    shown = sum(int(n) for n in re.findall(r'\*(\d+)×\*', text))
+    rest = int(re.search(r'И ещё \*(\d+)\*', text).group(1))
+    assert shown + rest == sum(g['count'] for g in digest.pending.values()) + 7
+    # the biggest groups are the ones shown
+    assert '*40×*' in text and '*1×*' not in text
+
+
+def test_small_digest_is_complete():
+    text = storm(3).render()
+    assert text.count('×*') == 3 and 'И ещё' not in text
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from database import DuplicateKeyError
+from handlers import db
+
+
+def test_ensure_indexes_creates_declared_indexes(database):
+    asyncio.run(db.db_ensure_indexes())
+    for name, indexes in db.INDEXES.items():
+        info = asyncio.run(database[name].index_information())
+        for keys, options in indexes:
+            index = info[options['name']]
+            assert index['key'] == keys
+            for option, value in options.items():
+                if option != 'name':
+                    assert index[option] == value
+
+
+def test_username_index_is_unique_and_sparse(database):
+    asyncio.run(db.db_ensure_indexes())
+    profiles = database['profiles']
+    asyncio.run(profiles.insert_one({'_id': 1, 'username': 'ivan'}))
+    asyncio.run(profiles.insert_one({'_id': 2}))
+    asyncio.run(profiles.insert_one({'_id': 3}))
+    with pytest.raises(DuplicateKeyError):
+        asyncio.run(profiles.insert_one({'_id': 4, 'username': 'ivan'}))
+
+
+def test_migration_normalises_usernames_with_index_in_place(database):
+    async def scenario():
+        await db.db_ensure_indexes()
+        profiles = database['profiles']
+        # written by an older version that stored usernames as Telegram sent them
+        await profiles.insert_one({'_id': 1, 'username': 'Ivan', 'access': 0, 'ban': 0})
+        await profiles.insert_one({'_id': 2, 'username': '@Petr', 'access': 1, 'ban': 0})
+        await profiles.insert_one({'_id': 3, 'username': None, 'access': 0, 'ban': 0})
+        await profiles.insert_one({'_id': 4, 'username': 'ivan', 'access': 0, 'ban': 0})
+        await db.db_ensure_indexes()
+        return {doc['_id']: doc for doc in await profiles.find({}).to_list(None)}
+
+    docs = asyncio.run(scenario())
+    assert docs[1]['username'] == 'ivan'
+    assert 'username' not in docs[4]
+    assert docs[2]['username'] == 'petr' and docs[2]['access'] == 1
+    assert 'username' not in docs[3]
+    assert asyncio.run(db.db_profile_get_by_username('@PETR'))['_id'] == 2
+    with pytest.raises(DuplicateKeyError):
+        asyncio.run(database['profiles'].insert_one({'_id': 5, 'username': 'petr'}))
+
+
+def test_first_migration_dedupes_usernames_before_the_index(database):
+    async def scenario():
+        profiles = database['profiles']
+        # a database from before the unique index: case variants and nicks nobody gave up
+        await profiles.insert_one({'_id': 1, 'username': 'Ivan', 'access': 0, 'ban': 0})
+        await profiles.insert_one({'_id': 2, 'username': 'ivan', 'access': 0, 'ban': 0})
+        await profiles.insert_one({'_id': 3, 'username': 'bob', 'access': 0, 'ban': 0})
+        await profiles.insert_one({'_id': 4, 'username': '@Bob', 'access': 2, 'ban': 0})
+        await profiles.insert_one({'_id': 5, 'username': 'petr', 'access': 0, 'ban': 0})
+        await db.db_ensure_indexes()
+        return {doc['_id']: doc.get('username') for doc in await profiles.find({}).to_list(None)}
+
+    assert asyncio.run(scenario()) == {1: 'ivan', 2: None, 3: 'bob', 4: None, 5: 'petr'}
+    assert 'username_unique' in asyncio.run(database['profiles'].index_information())
+
+
+def test_unique_index_is_not_built_over_duplicates(database):
+    profiles = database['profiles']
+    asyncio.run(profiles.insert_one({'_id': 1, 'username': 'ivan'}))
+    asyncio.run(profiles.insert_one({'_id': 2, 'username': 'ivan'}))
+    with pytest.raises(DuplicateKeyError):
+        asyncio.run(profiles.create_index([('username', 1)], name='username_unique', unique=True, sparse=True))
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from handlers import db
+
+
+@pytest.fixture
+def slow_profiles(database, monkeypatch):
+    profiles = database.collections['profiles']
+    monkeypatch.setattr(profiles, 'latency', 0.05)
+    asyncio.run(profiles.insert_one({'_id': 1, 'username': 'ivan', 'access': 2, 'ban': 0}))
+    db.db_cache_invalidate()
+    return profiles
+
+
+def test_concurrent_misses_share_one_read(slow_profiles):
+    async def scenario():
+        calls = slow_profiles.calls
+        results = await asyncio.gather(*[db.db_profile_get(1) for _ in range(5)])
+        return results, slow_profiles.calls - calls
+
+    results, calls = asyncio.run(scenario())
+    assert [profile['access'] for profile in results] == [2] * 5
+    assert calls == 1
+
+
+def test_cancelled_reader_does_not_strand_the_others(slow_profiles):
+    async def scenario():
+        leader = asyncio.create_task(db.db_profile_get(1))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(db.db_profile_get(1))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        profile = await asyncio.wait_for(follower, 1)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return profile
+
+    assert asyncio.run(scenario())['access'] == 2
+    assert db._pending == {}
+
+
+def test_failed_read_reaches_every_caller_and_is_not_cached(slow_profiles, monkeypatch):
+    async def broken(*args, **kwargs):
+        await asyncio.sleep(0.05)
+        raise ConnectionError('database is down')
+
+    monkeypatch.setattr(slow_profiles, 'find_one', broken)
+
+    async def scenario():
+        return await asyncio.wait_for(asyncio.gather(*[db.db_profile_get(1) for _ in range(3)],
+                                                     return_exceptions=True), 1)
+
+    assert all(isinstance(result, ConnectionError) for result in asyncio.run(scenario()))
+    assert 1 not in db._cache and db._pending == {}
@@ -0,0 +1,31 @@
+import pytest
+
+import router
+from router import Arg, Rest, Route, ticket_id
+
+
+def test_commands_without_arguments_ignore_trailing_text():
+    # /start ref_campaign deep links and /getchatid with anything after it
+    assert vars(Route(None, ['start'], [], 0, None).parse('ref_campaign')) == {}
+
+
+def test_arguments_are_parsed_by_the_schema():
+    route = Route(None, ['бан'], [Arg('uid', int), Rest('reason')], 2, '`/бан 1 Причина`')
+    args = route.parse('42  spam\nand abuse')
+    assert (args.uid, args.reason) == (42, 'spam\nand abuse')
+    with pytest.raises(ValueError):
+        route.parse('42')
+    with pytest.raises(ValueError):
+        route.parse('abc spam')
+
+    route = Route(None, ['вопросы'], [Arg('after', ticket_id, optional=True, default=0)], 1, '`/вопросы 120`')
+    assert route.parse('').after == 0
+    assert route.parse('#120').after == 120
+    with pytest.raises(ValueError):
+        route.parse('120 130')
+
+
+def test_commands_with_arguments_need_a_usage():
+    with pytest.raises(ValueError):
+        router.command(['test_no_usage'], None, args=[Arg('uid', int)])
+    assert 'test_no_usage' not in router.routes
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+from aiogram.utils.exceptions import RetryAfter
+
+from sender import Sender, PRIORITY_USER, PRIORITY_BULK
+
+
+class FakeBot:
+    # answers like Telegram after optional RetryAfter errors, and remembers when each call came in
+    def __init__(self, flood=0):
+        self.flood = flood
+        self.calls = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append((time.monotonic(), chat_id, text))
+        if self.flood:
+            self.flood -= 1
+            raise RetryAfter(1)
+        return text
+
+
+def make_sender(bot, retries=3):
+    return Sender(bot, workers=1, global_rate=1000, chat_rate=1000, group_rate=1000, retries=retries)
+
+
+def test_retry_after_pauses_and_retries():
+    async def scenario():
+        bot = FakeBot(flood=1)
+        sender = make_sender(bot)
+        sender.start()
+        result = await asyncio.wait_for(sender.send_message(1, 'hi'), 5)
+        await sender.close(1)
+        return bot, sender, result
+
+    bot, sender, result = asyncio.run(scenario())
+    assert result == 'hi'
+    assert len(bot.calls) == 2
+    assert bot.calls[1][0] - bot.calls[0][0] >= 0.9
+    assert (sender.sent, sender.retried, sender.failed) == (1, 1, 0)
+
+
+def test_retry_after_gives_up_after_retries():
+    async def scenario():
+        bot = FakeBot(flood=5)
+        sender = make_sender(bot, retries=1)
+        sender.start()
+        try:
+            await asyncio.wait_for(sender.send_message(1, 'hi'), 5)
+        except RetryAfter:
+            pass
+        else:
+            raise AssertionError('the message should have failed')
+        await sender.close(1)
+        return bot, sender
+
+    bot, sender = asyncio.run(scenario())
+    assert len(bot.calls) == 2
+    assert sender.failed == 1
+
+
+def test_user_messages_overtake_bulk():
+    async def scenario():
+        bot = FakeBot()
+        sender = make_sender(bot)
+        # queued before the worker starts, so only the priority decides the order
+        futures = [sender.send_message(i, f'bulk {i}', priority=PRIORITY_BULK) for i in range(3)]
+        futures.append(sender.send_message(10, 'user', priority=PRIORITY_USER))
+        sender.start()
+        await asyncio.gather(*futures)
+        await sender.close(1)
+        return bot
+
+    bot = asyncio.run(scenario())
+    assert [text for _, _, text in bot.calls] == ['user', 'bulk 0', 'bulk 1', 'bulk 2']
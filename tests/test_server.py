@@ -0,0 +1,90 @@
+import asyncio
+import socket
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestClient, TestServer
+
+import metrics
+import server
+from configurebot import cfg
+
+
+def make_update(update_id, text):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': 42, 'type': 'private'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'User'}}}
+
+
+def test_webhook_serves_updates_and_drain_waits_for_them(monkeypatch, bot_api):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    monkeypatch.setattr(server, 'inflight', server.InFlightMiddleware())
+    bot = Bot(token=cfg['token'])
+    dp = Dispatcher(bot, storage=MemoryStorage())
+    dp.middleware.setup(server.inflight)
+    started = asyncio.Event()
+    release = asyncio.Event()
+    handled = []
+
+    async def slow_handler(message: types.Message):
+        started.set()
+        await release.wait()
+        handled.append(message.text)
+
+    dp.register_message_handler(slow_handler)
+    # runs the executor's startup (getMe) on this loop, like start_webhook does before serving
+    webhook = server.make_webhook(dp, on_startup=None, on_shutdown=server.drain)
+
+    async def scenario():
+        client = TestClient(TestServer(webhook.web_app))
+        await client.start_server()
+        try:
+            post = asyncio.create_task(client.post(cfg['webhook_path'], json=make_update(1, 'вопрос')))
+            await asyncio.wait_for(started.wait(), 5)
+            health = await (await client.get('/health')).json()
+            assert health == {'status': 'ok', 'in_flight': 1}
+
+            drain = asyncio.create_task(server.drain(dp))
+            await asyncio.sleep(0.1)
+            assert not drain.done()
+            release.set()
+            await asyncio.wait_for(drain, 5)
+            assert handled == ['вопрос']
+
+            response = await post
+            assert response.status == 200
+            health = await (await client.get('/health')).json()
+            assert health['in_flight'] == 0
+            # metrics are served on metrics_host only, not on the public webhook listener
+            assert (await client.get('/metrics')).status == 404
+        finally:
+            await client.close()
+            await (await bot.get_session()).close()
+
+    try:
+        loop.run_until_complete(scenario())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    assert bot_api[0][0] == 'getMe'
+
+
+def test_metrics_have_their_own_listener():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    async def scenario():
+        runner = await metrics.serve('127.0.0.1', port)
+        try:
+            async with ClientSession() as session:
+                async with session.get(f'http://127.0.0.1:{port}/metrics') as response:
+                    return response.status, await response.text()
+        finally:
+            await runner.cleanup()
+
+    status, text = asyncio.run(scenario())
+    assert status == 200 and '# TYPE bot_updates_total counter' in text
@@ -0,0 +1,78 @@
+import asyncio
+import datetime
+
+from storage import MongoStorage
+
+
+def test_state_and_data_round_trip(database):
+    async def scenario():
+        storage = MongoStorage(ttl=60)
+        assert await storage.get_state(chat=1, user=1) is None
+        await storage.set_state(chat=1, user=1, state='FSMQuestion:text')
+        await storage.set_data(chat=1, user=1, data={'a': 1})
+        await storage.update_data(chat=1, user=1, b=2)
+        await storage.update_data(chat=1, user=1, data={'a': 3})
+        assert await storage.get_state(chat=1, user=1) == 'FSMQuestion:text'
+        assert await storage.get_data(chat=1, user=1) == {'a': 3, 'b': 2}
+        # other chats don't see it
+        assert await storage.get_state(chat=2, user=1) is None
+
+        await storage.reset_state(chat=1, user=1, with_data=False)
+        assert await storage.get_state(chat=1, user=1) is None
+        assert await storage.get_data(chat=1, user=1) == {'a': 3, 'b': 2}
+
+        await storage.set_state(chat=1, user=1, state='FSMQuestion:text')
+        await storage.finish(chat=1, user=1)
+        assert await storage.get_state(chat=1, user=1) is None
+        assert await storage.get_data(chat=1, user=1) == {}
+
+    asyncio.run(scenario())
+    # a finished conversation leaves nothing behind
+    assert database['fsm'].docs == {}
+
+
+def test_idle_state_expires(database):
+    async def scenario():
+        storage = MongoStorage(ttl=60)
+        await storage.set_state(chat=1, user=1, state='FSMQuestion:text')
+        database['fsm'].docs['1:1']['updated'] -= datetime.timedelta(seconds=61)
+        assert await storage.get_state(chat=1, user=1) is None
+
+    asyncio.run(scenario())
+    assert database['fsm'].docs == {}
+
+
+def test_lock_serialises_workers(database):
+    # two storages over one database stand for two bot processes
+    events = []
+
+    async def worker(storage, name, hold):
+        async with storage.lock(chat=1, user=1):
+            events.append(f'{name} in')
+            await asyncio.sleep(hold)
+            events.append(f'{name} out')
+
+    async def scenario():
+        first, second = MongoStorage(ttl=60), MongoStorage(ttl=60)
+        one = asyncio.create_task(worker(first, 'a', 0.2))
+        await asyncio.sleep(0.05)
+        await asyncio.gather(one, worker(second, 'b', 0), worker(first, 'c', 0))
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert events[:2] == ['a in', 'a out']
+    assert sorted(events[2:]) == ['b in', 'b out', 'c in', 'c out']
+    assert database['fsm_locks'].docs == {}
+    assert first._locks == {} and second._locks == {}
+
+
+def test_lock_takes_over_an_expired_lease(database):
+    async def scenario():
+        storage = MongoStorage(ttl=60)
+        # left behind by a worker that died while holding the lock
+        await database['fsm_locks'].insert_one({'_id': '1:1', 'owner': 'dead',
+                                                'expires': datetime.datetime.utcnow() - datetime.timedelta(seconds=1)})
+        async with storage.lock(chat=1, user=1):
+            return database['fsm_locks'].docs['1:1']['owner']
+
+    assert asyncio.run(asyncio.wait_for(scenario(), 5)) != 'dead'
@@ -0,0 +1,71 @@
+import asyncio
+import itertools
+
+import pytest
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+
+import router
+import throttle
+from throttle import MemoryCounters, ThrottleMiddleware
+
+_ids = itertools.count(1)
+
+
+def message(text=None, chat_id=5, media_group_id=None):
+    data = {'message_id': next(_ids), 'date': 0, 'from': {'id': 5, 'is_bot': False, 'first_name': 'User'},
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'}}
+    if text is not None:
+        data['text'] = text
+    if media_group_id is not None:
+        data['media_group_id'] = media_group_id
+    return types.Message(**data)
+
+
+@pytest.fixture
+def warnings(monkeypatch):
+    sent = []
+
+    class Recorder:
+        def send_message(self, chat_id, text, **kwargs):
+            sent.append(chat_id)
+
+    monkeypatch.setattr(throttle, 'sender', Recorder())
+    return sent
+
+
+def passed(middleware, messages):
+    async def scenario():
+        results = []
+        for m in messages:
+            try:
+                await middleware.on_pre_process_message(m, {})
+            except CancelHandler:
+                results.append(False)
+            else:
+                results.append(True)
+        return results
+    return asyncio.run(scenario())
+
+
+def make_middleware():
+    return ThrottleMiddleware({'default': (2, 60)}, MemoryCounters(100), 100)
+
+
+def test_private_messages_are_limited_and_warned_once(warnings):
+    assert passed(make_middleware(), [message('hi') for _ in range(4)]) == [True, True, False, False]
+    assert warnings == [5]
+
+
+def test_album_counts_once(warnings):
+    album = [message(media_group_id='a') for _ in range(5)]
+    assert passed(make_middleware(), album + [message('hi'), message('hi')]) == [True] * 6 + [False]
+
+
+def test_group_chatter_is_not_counted(monkeypatch, warnings):
+    monkeypatch.setitem(router.routes, 'ответ', router.Route(None, ['ответ'], [], 1, None))
+    middleware = make_middleware()
+    assert passed(middleware, [message('hi', chat_id=-100) for _ in range(5)]) == [True] * 5
+    # a flooding command in a group is dropped without a reply there
+    assert passed(middleware, [message('/ответ', chat_id=-100) for _ in range(3)]) == [True, True, False]
+    assert warnings == []
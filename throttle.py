@@ -0,0 +1,124 @@
+import datetime
+import time
+from collections import OrderedDict
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from configurebot import cfg
+from database import get_database, ReturnDocument
+import metrics
+import router
+from sender import sender
+
+
+def estimate(current, previous, now, period):
+    # sliding window approximated from two fixed ones: the previous window counts for the part still inside
+    return current + previous * (1 - now % period / period)
+
+
+class MemoryCounters:
+    # counts per "user:key" for one worker; the least recently active entries are dropped past max_keys
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        #key -> [window, current count, previous count]
+        self.entries = OrderedDict()
+
+    async def hit(self, key, period, now):
+        window = int(now // period)
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] < window - 1:
+            entry = [window, 0, 0]
+        elif entry[0] == window - 1:
+            entry = [window, 0, entry[1]]
+        entry[1] += 1
+        self.entries[key] = entry
+        if len(self.entries) > self.max_keys:
+            self.entries.popitem(last=False)
+        return estimate(entry[1], entry[2], now, period)
+
+
+class SharedCounters:
+    # the same counters in the database, one document per key and window, for several workers
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def hit(self, key, period, now):
+        window = int(now // period)
+        current = await self.collection.find_one_and_update(
+            {'_id': f'{key}:{window}'},
+            {'$inc': {'n': 1}, '$setOnInsert': {'expires': datetime.datetime.utcnow() + datetime.timedelta(seconds=2 * period)}},
+            projection={'n': 1}, upsert=True, return_document=ReturnDocument.AFTER)
+        previous = await self.collection.find_one({'_id': f'{key}:{window - 1}'}, {'n': 1})
+        return estimate(current['n'], previous['n'] if previous else 0, now, period)
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    """
+    Per-user flood control, checked before the filters run, so a throttled message costs no database reads
+    (unless the counters themselves are shared) and never reaches a handler.
+
+    Limits are set per command (by its first name, aliases share it), per button and for other messages
+    in private chats; group chatter isn't aimed at the bot and isn't counted. A throttled user is told
+    once per period in a private chat, everything else is dropped silently.
+    """
+
+    def __init__(self, limits, counters, max_keys):
+        super().__init__()
+        self.limits = limits
+        self.counters = counters
+        self.max_keys = max_keys
+        self.buttons = {cfg['button_new_question']: 'button_new_question',
+                        cfg['button_about_us']: 'button_about_us'}
+        #"user:key" -> time the user was last told, bounded like the counters
+        self.warned = OrderedDict()
+        #album ids already counted; the other parts of an album pass free
+        self.albums = OrderedDict()
+
+    def classify(self, message: types.Message):
+        text = message.text
+        if text:
+            if text.startswith('/'):
+                route = router.routes.get(text.split(maxsplit=1)[0][1:].partition('@')[0].lower())
+                if route is not None:
+                    return route.names[0]
+            elif text in self.buttons:
+                return self.buttons[text]
+        return 'message'
+
+    def _remember(self, entries, key, value):
+        entries.pop(key, None)
+        entries[key] = value
+        if len(entries) > self.max_keys:
+            entries.popitem(last=False)
+
+    async def on_pre_process_message(self, message: types.Message, data):
+        if message.from_user is None:
+            return
+        private = message.chat.type == types.ChatType.PRIVATE
+        name = self.classify(message)
+        if name == 'message' and not private:
+            return
+        if message.media_group_id is not None:
+            if message.media_group_id in self.albums:
+                return
+            self._remember(self.albums, message.media_group_id, True)
+        limit, period = self.limits.get(name) or self.limits['default']
+        key = f'{message.from_user.id}:{name}'
+        now = time.time()
+        if await self.counters.hit(key, period, now) <= limit:
+            return
+        metrics.throttled.inc(name)
+        if private and now - self.warned.get(key, 0) >= period:
+            self._remember(self.warned, key, now)
+            sender.send_message(message.chat.id, cfg['throttle_message'], parse_mode='Markdown')
+        raise CancelHandler()
+
+
+if cfg['throttle_backend'] == 'shared':
+    counters = SharedCounters(get_database()['throttle'])
+else:
+    counters = MemoryCounters(cfg['throttle_max_keys'])
+
+middleware = ThrottleMiddleware(cfg['throttle_limits'], counters, cfg['throttle_max_keys'])